@@ -0,0 +1,225 @@
+from os import makedirs
+import argparse
+import errno
+import resource
+import time
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from consts import PERFORMANCE_DIRECTORY, DEFAULT_K
+import cluster
+from cluster import lloyd
+from fcluster import ENGINES
+from utils import parse_range_list
+
+"""
+file: benchmark
+
+purpose:
+ - reproducible benchmarks of the naive clustering (cluster.py) against every fcluster engine
+ - every dataset is generated from a seed, so each engine clusters exactly the same data
+ - every run happens in a fresh process, so the peak RSS of one run doesn't leak into the next
+ - results are written as .csv files in the Data/performance layout, for generate_performance_analysis_graphs.py
+"""
+
+NAIVE_ENGINE = 'naive'
+BENCHMARK_ENGINES = [NAIVE_ENGINE, *ENGINES]
+
+# metric -> axis label
+METRICS = {
+    'wall_time': 'Wall time (s)',
+    'peak_rss': 'Peak RSS (MB)',
+    'iterations': 'Number of iterations',
+    'operations': 'Number of operations',
+}
+
+SIZE_COLUMN = 'Dataset size'
+K_COLUMN = 'k'
+
+PACKED_STEP = 0.0005        # roughly the scale_factor of the packed ERA5 shorts, in degrees
+FREEZING_SEA = -1.8         # sea surface temperature can't go below the freezing point of sea water
+
+# Don't time the naive clustering's debug printing
+cluster.DEBUG = False
+
+
+def get_uniform_distribution(rng, size):
+    return rng.uniform(0, 10000, size)
+
+
+def get_normal_distribution(rng, size):
+    return rng.normal(2000, 500, size)
+
+
+def get_overlap_distribution(rng, size):
+    mids = [200, 800, 1200, 1500]
+    return np.concatenate([rng.normal(mid, 150, size_each) for mid, size_each in zip(mids, split_size(size, len(mids)))])
+
+
+def get_era5_distribution(rng, size):
+    """
+    Sea surface temperature like data: warm at the equator and cold at the poles, clipped at the
+    freezing point of sea water and rounded to the resolution of the packed ERA5 values,
+    so there are many duplicates and a spike at the minimum
+    """
+
+    lats = rng.uniform(-np.pi / 2, np.pi / 2, size)
+    values = np.maximum(30 * np.cos(lats)**2 - 2 + rng.normal(0, 1.5, size), FREEZING_SEA)
+
+    return np.round(values / PACKED_STEP) * PACKED_STEP
+
+
+DISTRIBUTIONS = {
+    'uniform': get_uniform_distribution,
+    'normal': get_normal_distribution,
+    'overlap': get_overlap_distribution,
+    'era5': get_era5_distribution,
+}
+
+
+def split_size(size, parts):
+    """Split size into parts that add back up to size"""
+
+    return [size // parts + (1 if i < size % parts else 0) for i in range(parts)]
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB (ru_maxrss is in KB on Linux)"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_benchmark(engine, distribution, size, k, seed):
+    """
+    Generate a dataset from the seed, then time clustering it with a single engine
+
+    The timed region includes sorting the dataset for the fcluster engines, since the naive clustering doesn't need it
+
+    returns:
+     - dict of the run parameters and every metric
+    """
+
+    rng = np.random.default_rng(seed)
+    dataset = DISTRIBUTIONS[distribution](rng, size)
+
+    start = time.perf_counter()
+    if engine == NAIVE_ENGINE:
+        (_, iters, operations) = lloyd(dataset, k, rng)
+    else:
+        (_, iters, operations) = ENGINES[engine](np.sort(dataset), k)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'engine': engine,
+        'distribution': distribution,
+        SIZE_COLUMN: size,
+        K_COLUMN: k,
+        'seed': seed,
+        'wall_time': elapsed,
+        'peak_rss': peak_rss(),
+        'iterations': int(iters),
+        'operations': int(operations),
+    }
+
+
+def run_benchmarks(engines, distributions, sizes, ks, repeats, seed=0, processes=1):
+    """
+    Run every engine over every distribution x size x k, repeats times each
+
+    Repeat r of every engine uses the dataset generated from seed + r.
+    Each run gets its own spawned process, so keep processes at 1 for undisturbed wall times.
+
+    returns:
+     - DataFrame with one row per run
+    """
+
+    tasks = [
+        (engine, distribution, size, k, seed + repeat)
+        for distribution in distributions
+        for size in sizes
+        for k in ks
+        for repeat in range(repeats)
+        for engine in engines
+    ]
+
+    with mp.get_context('spawn').Pool(processes, maxtasksperchild=1) as pool:
+        results = []
+        for result in pool.imap(run_benchmark_task, tasks):
+            print(f"{result['engine']} {result['distribution']} n={result[SIZE_COLUMN]} k={result[K_COLUMN]}: "
+                  f"{result['wall_time']:.4f}s {result['peak_rss']:.1f}MB "
+                  f"{result['iterations']} iterations {result['operations']} operations")
+            results.append(result)
+
+    return pd.DataFrame(results)
+
+
+def run_benchmark_task(task):
+    return run_benchmark(*task)
+
+
+def write_results(results, output_dir):
+    """
+    Write the raw results, and the median of every metric over the repeats as one .csv per metric and distribution
+     - {metric}_{distribution}_k={k}.csv : dataset size against each engine
+     - {metric}_{distribution}_n={size}.csv : k against each engine
+    """
+
+    results.to_csv(f"{output_dir}/results.csv", index=False)
+
+    medians = results.groupby(['distribution', SIZE_COLUMN, K_COLUMN, 'engine'], sort=False)[list(METRICS)].median().reset_index()
+
+    for metric in METRICS:
+        for distribution, data in medians.groupby('distribution', sort=False):
+            for (x, fixed, name) in [(SIZE_COLUMN, K_COLUMN, 'k'), (K_COLUMN, SIZE_COLUMN, 'n')]:
+                for value, series in data.groupby(fixed, sort=False):
+                    if series[x].nunique() < 2:
+                        continue
+
+                    table = series.pivot(index=x, columns='engine', values=metric)
+                    table = table[[engine for engine in BENCHMARK_ENGINES if engine in table.columns]]
+
+                    path = f"{output_dir}/{metric}_{distribution}_{name}={value}.csv"
+                    print(f"Writing {path}")
+                    table.to_csv(path)
+
+
+def init(output_dir):
+    """Initialization for the benchmarks"""
+
+    # Create the output directory if it doesn't exist
+    try:
+        makedirs(output_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help='Output subdirectory', default='benchmark')
+    parser.add_argument('-e', '--engines', help='Comma separated engines', default=','.join(BENCHMARK_ENGINES))
+    parser.add_argument('-d', '--distributions', help='Comma separated distributions', default=','.join(DISTRIBUTIONS))
+    parser.add_argument('-n', '--sizes', help='Dataset sizes, a list/range (e.g. 10000-100000:10000)', default='10000,50000,100000')
+    parser.add_argument('-k', '--k', help='k values, a list/range (e.g. 5-25:5)', default=f"5,{DEFAULT_K}")
+    parser.add_argument('-r', '--repeats', type=int, help='Number of datasets for each setting', default=3)
+    parser.add_argument('-s', '--seed', type=int, help='Seed of the first dataset', default=0)
+    parser.add_argument('-p', '--processes', type=int, help='Number of benchmarks to run at once', default=1)
+    args = parser.parse_args()
+
+    engines = args.engines.split(',')
+    distributions = args.distributions.split(',')
+    for engine in engines:
+        if engine not in BENCHMARK_ENGINES:
+            parser.error(f"unknown engine {engine}, choose from {BENCHMARK_ENGINES}")
+    for distribution in distributions:
+        if distribution not in DISTRIBUTIONS:
+            parser.error(f"unknown distribution {distribution}, choose from {list(DISTRIBUTIONS)}")
+
+    output_dir = f"{PERFORMANCE_DIRECTORY}/{args.output}"
+    init(output_dir)
+
+    results = run_benchmarks(
+        engines, distributions, parse_range_list(args.sizes), parse_range_list(args.k), args.repeats, args.seed, args.processes
+    )
+
+    write_results(results, output_dir)
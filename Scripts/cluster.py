@@ -1,173 +1,153 @@
-from os import listdir, makedirs
-from os.path import isfile, isdir, join, basename
+from os import makedirs
+from os.path import isfile, isdir, dirname
 import argparse
 import errno
 import json
-from random import randint
-import multiprocessing as mp
+import time
 import numpy as np
-from consts import TOTAL_LAT, TOTAL_LON, VARIABLES, CONVERTED_DIRECTORY, CLUSTERED_DIRECTORY, DEFAULT_K
+from consts import CONVERTED_DIRECTORY, CLUSTERED_DIRECTORY, DEFAULT_K
+from storage import read_day, write_day, open_cube, create_cube, read_metadata, read_grid, prepare_day_directory
+from workers import run
+import instrument
 
 DEBUG = True
 
 
-def choose_random_duplicate(clustermeans, index, backwards):
-    """Break ties for clusters with identical means"""
-
-    if not backwards:
-        duplicate_count = 0
-        for i in range(index+1, len(clustermeans)):
-            if clustermeans[i] == clustermeans[index]:
-                duplicate_count += 1
-
-        # If we have duplicates, randomly choose one to assign the datapoint to
-        if duplicate_count > 0:
-            return randint(index, index + duplicate_count)
-        else:
-            return index
-    else:
-        duplicate_count = 0
-        for i in range(index-2, -1, -1):
-            if clustermeans[i] == clustermeans[index-1]:
-                duplicate_count += 1
-
-        # If we have duplicates, randomly choose one to assign the datapoint to
-        if duplicate_count > 0:
-            return randint(index - duplicate_count - 1, index-1)
-        else:
-            return index-1
-
-
-def closest_search(datapoint, clustermeans):
-    # Finds the lowest index such that datapoint <= clustermeans[index]
-    index = np.searchsorted(clustermeans, datapoint)
-
-    # If the index is zero, then it's equal or smaller than the smallest element.
-    if index == 0:
-        return choose_random_duplicate(clustermeans, index, False)
-
-    # If the index is equal to the array length then it's larger than the largest element.
-    if index == len(clustermeans):
-        return choose_random_duplicate(clustermeans, index, True)
-
-    # Now we have that datapoint <= clustermeans[index] && index > 0
-    # Check which is closer: index or index-1
-    ind_diff = abs(clustermeans[index] - datapoint)
-    indm1_diff = abs(clustermeans[index-1] - datapoint)
-
-    # If ind_diff == indm1_diff then the datapoint is *exactly* halfway between the two
-    if ind_diff == indm1_diff:
-        return randint(index-1, index)
-    elif ind_diff < indm1_diff:
-        return choose_random_duplicate(clustermeans, index, False)
-    else:
-        return choose_random_duplicate(clustermeans, index, True)
-
-
-def cluster(data, k):
-    """
-    cluster
-
-    algorithm overview:
-        1: Choose k random points, assign the mean of each cluster to the value of its single data point
-        2: Assign each data point its cluster based on which mean is closest
-        3: Calculate the new means for each cluster based on the data points inside
-        4: If the new means are different than the previous means, repeat from step 2
+def lloyd(dataset, k, rng):
     """
+    Naive Lloyd iterations over an unsorted dataset
 
-    # 1: Choose k random points (sea surface temperature)
-    means = np.zeros(k)
-    new_means = np.zeros(k)
+    Every iteration measures the distance from every datapoint to every mean in one broadcast,
+    labels each datapoint with its closest mean, and recomputes the means with weighted bincounts.
 
-    cluster_points = [np.zeros(TOTAL_LAT*TOTAL_LON) for i in range(k)]
-    cluster_count = [0 for i in range(k)]
+    parameters:
+     - dataset : 1d array of datapoints to cluster (no NaN)
+     - k : number of clusters
+     - rng : numpy random Generator used to choose the initial means (distinct values of the dataset)
 
-    for i in range(k):
-        x = None
-        while x is None:
-            x = data[randint(0, TOTAL_LAT-1)][randint(0, TOTAL_LON-1)]
-        new_means[i] = x
+    returns:
+     - sorted cluster means
+     - number of iterations
+     - number of operations (distance computations)
+    """
 
-    # Sort means by magnitude
-    new_means.sort()
+    # 1: Choose k random distinct values, the mean of each cluster is the value of its single data point
+    # (a repeated value would leave an empty duplicate cluster, so there are fewer clusters if there are fewer than k values)
+    values = np.unique(dataset)
+    new_means = np.sort(rng.choice(values, min(k, len(values)), replace=False))
+    k = len(new_means)
+    means = np.full(k, np.nan)
 
     if DEBUG:
         print(new_means)
 
+    iters = 0
+    operations = 0
     while not np.array_equal(means, new_means):
-        means = new_means.copy()
-        new_means = np.zeros(k)
-
-        # 2: Assign each value to whichever mean is closest (random tiebreaker)
-        for i in range(TOTAL_LAT):
-            for j in range(TOTAL_LON):
-                if data[i][j] is None:
-                    continue
-                cluster = closest_search(data[i][j], means)
-                cluster_points[cluster][cluster_count[cluster]] = data[i][j]
-                cluster_count[cluster] += 1
+        iters += 1
+        means = new_means
 
-        if DEBUG:
-            print(cluster_count)
+        # 2: Assign each value to whichever mean is closest
+        labels = np.argmin(np.abs(dataset[:, np.newaxis] - means), axis=1)
+        operations += len(dataset) * k
 
-        # 3: Calculate new cluster means
-        for i in range(k):
-            new_means[i] = np.resize(cluster_points[i], cluster_count[i]).mean()
+        # 3: Calculate new cluster means, an empty cluster keeps its previous mean
+        counts = np.bincount(labels, minlength=k)
+        sums = np.bincount(labels, weights=dataset, minlength=k)
 
-            # Reset cluster count to prevent bad things
-            cluster_count[i] = 0
+        if DEBUG:
+            print(counts)
 
+        new_means = means.copy()
+        nonempty = counts > 0
+        new_means[nonempty] = sums[nonempty] / counts[nonempty]
         new_means.sort()
 
         # 4: If means are different than new means, go back to 2
 
+    return (new_means, iters, operations)
+
+
+def cluster(data, k, seed=None):
+    """
+    cluster
+
+    algorithm overview:
+        1: Choose k random points, assign the mean of each cluster to the value of its single data point
+        2: Assign each data point its cluster based on which mean is closest
+        3: Calculate the new means for each cluster based on the data points inside
+        4: If the new means are different than the previous means, repeat from step 2
+
+    parameters:
+     - data : 2d grid to cluster (NaN for missing cells)
+     - k : number of clusters
+     - seed : seed for choosing the initial means (random if None)
+    """
+
+    data = np.array(data, dtype=np.float64)
+    valid = ~np.isnan(data)
+    dataset = data[valid]
+
+    (means, _, _) = lloyd(dataset, k, np.random.default_rng(seed))
+
     # We now have the final clustering - display the means of each cluster!
     if DEBUG:
-        print(new_means)
+        print(means)
 
     # For each data point, find its cluster and make the value of the data point equal to the mean of the cluster.
-    for i in range(TOTAL_LAT):
-        for j in range(TOTAL_LON):
-            if data[i][j] is None:
-                continue
-            cluster = closest_search(data[i][j], new_means)
-            data[i][j] = new_means[cluster]
+    data[valid] = means[np.argmin(np.abs(dataset[:, np.newaxis] - means), axis=1)]
 
-    min = np.nanmin(np.array(data, dtype=np.float64))
-    max = np.nanmax(np.array(data, dtype=np.float64))
+    min = np.nanmin(data)
+    max = np.nanmax(data)
 
     return (data, min, max)
 
 
-def cluster_file(filename, k, output_dir):
+def cluster_file(path, index, k, output_dir, seed=None):
     """
-    Given a filename and k value, run fcluster on the file and write to output_dir
+    Given a day file (or a cube directory and day index) and k value, run cluster on the day and write to output_dir
+
+    index is None for a day file, which is always written to its own file (see storage.write_day)
 
     returns the min/max values for each variable
     """
     if DEBUG:
-        print('Clustering', filename)
+        print('Clustering', path, index)
 
-    with open(filename, 'r') as my_file:
-        data = json.load(my_file)
+    day, data = read_day(path, index)
+    data = {var: np.array(grid, dtype=np.float64) for var, grid in data.items()}
 
     ranges = {}     # keep track of min/max values for each variable
 
-    for variable in VARIABLES:
-        data[variable], min, max = cluster(data[variable], k)
-        ranges[variable] = (min, max)
+    for variable in data:
+        data[variable], min, max = cluster(data[variable], k, seed)
+        ranges[variable] = (float(min), float(max))
 
-    # Write clustered data to new .json file
-    with open(f"{output_dir}/{basename(filename)}", 'w') as outfile:
-        json.dump(data, outfile)
+    # Now write this to the output so it can be mapped.
+    write_day(output_dir, index, day, data)
 
     return ranges
 
 
+def cluster_grid(grid, state, k, seed=None):
+    """
+    Worker function (see workers.run_task): run cluster on a single grid
+
+    returns:
+     - the clustered grid
+     - (min, max)
+     - no state, every day is clustered on its own
+    """
+
+    (clustered, min, max) = cluster(grid, k, seed)
+
+    return ({k: clustered}, (float(min), float(max)), None)
+
+
 def get_variable_ranges(results):
     """Calculate the max/min value of each clustered variable"""
 
-    ranges = {var: {'min': [], 'max': []} for var in VARIABLES}
+    ranges = {var: {'min': [], 'max': []} for var in results[0]}
 
     for result in results:
         for var, val in result.items():
@@ -194,11 +174,14 @@ def init(output_dir):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input', help='Input JSON file')
+    parser.add_argument('-i', '--input', help='Input day file or cube directory')
     parser.add_argument('-o', '--output', help='Output subdirectory')
     parser.add_argument('-k', '--k', help='k value', default=DEFAULT_K)
+    parser.add_argument('-s', '--seed', type=int, help='Seed for choosing the initial means', default=None)
     args = parser.parse_args()
 
+    start = time.perf_counter()
+
     # If we specify a custom output dir, place it inside the default output directory
     output_dir = f"{CLUSTERED_DIRECTORY}/{args.output}" if args.output else CLUSTERED_DIRECTORY
 
@@ -209,7 +192,14 @@ if __name__ == '__main__':
     # If input is a single file, easy case
     if args.input and isfile(args.input):
         print('Cluster', args.input, output_dir)
-        cluster_file(args.input, args.k)
+
+        # The day is written to its own <day>.npy file, next to (never into) any cube already in the output directory
+        try:
+            prepare_day_directory(output_dir, read_metadata(dirname(args.input) or '.')['variables'], read_grid(args.input))
+        except ValueError as e:
+            parser.error(str(e))
+
+        cluster_file(args.input, None, args.k, output_dir, args.seed)
         exit()
 
     # Since input isn't a single file, it's either
@@ -217,16 +207,18 @@ if __name__ == '__main__':
     #   b) not specified
     input_dir = args.input if args.input and isdir(args.input) else CONVERTED_DIRECTORY
 
-    print('Cluster files in', input_dir)
+    print('Cluster days in', input_dir)
 
-    # Collect all the .json files in input_dir
-    files = [f"{input_dir}/{f}" for f in listdir(input_dir) if isfile(join(input_dir, f)) if f.endswith('json')]
+    # The clustered days are written into a cube with the same layout as the input
+    input_cube, metadata = open_cube(input_dir)
+    create_cube(output_dir, metadata['days'], input_cube.shape[2:], metadata['variables'], read_grid(input_dir))
 
-    pool = mp.Pool(mp.cpu_count())
-    results = pool.starmap(cluster_file, [(file, args.k, output_dir) for file in files])
+    results = run(cluster_grid, input_dir, {args.k: output_dir}, (args.k, args.seed))
 
     # Calculate min/max across the clusters for each variable
-    ranges = get_variable_ranges(results)
+    ranges = get_variable_ranges([dict(zip(metadata['variables'], day_results)) for day_results in results])
 
     with open(f"{output_dir}/range.json", 'w') as outfile:
         json.dump(ranges, outfile)
+
+    instrument.write_report(output_dir, 'cluster', time.perf_counter() - start)
@@ -1,4 +1,5 @@
 import os
+import numpy as np
 
 YEAR = 2019
 
@@ -12,6 +13,8 @@ DATA_DIRECTORY = os.getcwd() + '/../Data'
 CONVERTED_DIRECTORY = DATA_DIRECTORY + '/converted'
 CLUSTERED_DIRECTORY = DATA_DIRECTORY + '/clustered'
 FCLUSTERED_DIRECTORY = DATA_DIRECTORY + '/fclustered'
+VCLUSTERED_DIRECTORY = DATA_DIRECTORY + '/vclustered'
+PERFORMANCE_DIRECTORY = DATA_DIRECTORY + '/performance'
 VISUALS_DIRECTORY = os.getcwd() + '/../Visuals'
 
 VARIABLES = [
@@ -21,3 +24,56 @@ VARIABLES = [
 ]
 
 DEG = u'\N{DEGREE SIGN}'
+
+# Every variable that can be converted from the source NetCDF file, by name:
+#  - name/units: used to label plots
+#  - sources: the source variables it is calculated from
+#  - calculate: calculates it (in its units) from the cell means of its sources (in the source units), in the order of sources
+#  - pointwise: if True, calculate is given the unpacked source points instead, and its result is averaged into cells
+#    (for values that don't commute with the mean, e.g. a speed from its vector components)
+REGISTRY = {
+    'two_metre_temperature': {
+        'name': 'Two Metre Temperature',
+        'units': DEG + ' C',
+        'sources': ['t2m'],
+        'calculate': lambda t2m: t2m - KELVIN,
+    },
+    'mean_sea_level_pressure': {
+        'name': 'Mean Sea Level Pressure',
+        'units': 'kPa',
+        'sources': ['msl'],
+        'calculate': lambda msl: msl / 1000,
+    },
+    'sea_surface_temperature': {
+        'name': 'Sea Surface Temperature',
+        'units': DEG + ' C',
+        'sources': ['sst'],
+        'calculate': lambda sst: sst - KELVIN,
+    },
+    'ten_metre_u_wind': {
+        'name': 'Ten Metre U Wind',
+        'units': 'm/s',
+        'sources': ['u10'],
+        'calculate': lambda u10: u10,
+    },
+    'ten_metre_v_wind': {
+        'name': 'Ten Metre V Wind',
+        'units': 'm/s',
+        'sources': ['v10'],
+        'calculate': lambda v10: v10,
+    },
+    # The mean of the wind speed at every source point in each cell (not the speed of the mean wind, where opposing winds cancel)
+    'ten_metre_wind_speed': {
+        'name': 'Ten Metre Wind Speed',
+        'units': 'm/s',
+        'sources': ['u10', 'v10'],
+        'pointwise': True,
+        'calculate': lambda u10, v10: np.hypot(u10, v10),
+    },
+    'total_cloud_cover': {
+        'name': 'Total Cloud Cover',
+        'units': '%',
+        'sources': ['tcc'],
+        'calculate': lambda tcc: tcc * 100,
+    },
+}
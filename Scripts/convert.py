@@ -1,18 +1,28 @@
 import os
 import errno
-import json
 import argparse
+import time
 from netCDF4 import Dataset
 import numpy as np
 import multiprocessing as mp
-from consts import TOTAL_LAT, TOTAL_LON, DAYS_IN_YEAR, KELVIN, VARIABLES, DATA_DIRECTORY, CONVERTED_DIRECTORY, CONVERTED_DIRECTORY
+from consts import DAYS_IN_YEAR, VARIABLES, REGISTRY, DATA_DIRECTORY, CONVERTED_DIRECTORY, CONVERTED_DIRECTORY
+from collections import deque
+from storage import update_cube, DTYPE
+from manifest import hash_arrays, read_manifest, write_manifest, record_day
+import instrument
+from instrument import timer, count, BYTES_READ, BYTES_WRITTEN, CELLS
 
 """
 file: convert_dataset
 
 purpose:
- - convert data from the raw large NetCDF file to a reduced size JSON file
- - only select the variables we want
+ - convert data from the raw large NetCDF file to a reduced size cube of days
+ - only select the variables we want (any in consts.REGISTRY, including ones calculated from several source variables)
+ - average the source points into cells of the chosen resolution, optionally only within a lat/lon bounding box
+   (only that part of the source grid is read)
+ - the packed shorts are regridded as integers, without unpacking every source value to floats
+ - days are streamed: the main process reads one day at a time, a fixed pool of workers regrids them,
+   and the results are written in order, so only a few days are ever held in memory
 """
 
 OUTPUT_DIRECTORY = CONVERTED_DIRECTORY
@@ -21,79 +31,324 @@ DEFAULT_INPUT_FILENAME = DATA_DIRECTORY + '/EAR5-01-01-2020.nc'
 
 COMPRESS = True
 
-LAT_LON_PRECISION = 4       # how many pieces lat/lon is divided into (i.e. each integer lat/lon has 4 data points)
-MASK_THRESHOLD = 5          # might need to tweak this, the values seem to be within 0-256, but not fully understood yet
+RESOLUTIONS = [0.25, 0.5, 1, 2]     # degrees per output cell, each cell averages a block of the 0.25 degree source points
+DEFAULT_RESOLUTION = 1
+GLOBE = (-90, 90, 0, 360)           # south, north, west, east
 
+MASK_THRESHOLD = 5 / 16     # fraction of masked sst points in a cell above which it is dropped (5 of the 16 in a 1 degree cell)
 
-def mean(var, day, lat, lon):
+MASK_SOURCE = 'sst'         # cells without enough sea surface temperature points (i.e. land) are dropped from every variable
+
+IN_FLIGHT_PER_WORKER = 2    # days read ahead of the writer for each worker, bounds how many days are held in memory
+CHUNK_CACHE_LIMIT = 2**28   # bytes, per variable
+
+
+def block_mean(values, scale_factor, add_offset, fill_value, precision):
     """
-    Given date & lat/long, calculate the mean of all data points within the lat/long for that date,
-    since our dataset stores lat long in increments of 0.25
+    Given a (lat, lon) slab of packed shorts (or unpacked floats) for a single day, calculate the mean of every precision x precision block
+    of data points, i.e. of the points that fall within each output cell, since our dataset stores lat long in increments of 0.25
 
-    ie) mean(lat,lon + (lat+0.25),lon + (lat+0.5),lon + (lat+0.75...)....etc
+    ie) for 1 degree cells: mean(lat,lon + (lat+0.25),lon + (lat+0.5),lon + (lat+0.75...)....etc
+
+    Packed blocks are summed as integers straight from the packed values (skipping fill values),
+    and the scale and offset are only applied once to each block mean
+
+    returns:
+     - grid of block means, NaN where the whole block is missing
+     - grid with the number of masked values in each block
     """
 
-    values = var[day, (LAT_LON_PRECISION*lat):(LAT_LON_PRECISION*(lat+LAT_LON_PRECISION)), (LAT_LON_PRECISION*lon):(LAT_LON_PRECISION*(lon+LAT_LON_PRECISION))]
+    rows, columns = values.shape
+    blocks = values.reshape(rows // precision, precision, columns // precision, precision)
+
+    if np.issubdtype(values.dtype, np.integer):
+        # A block holds at most 64 shorts, so the sums fit in an int32
+        sums = blocks.sum(axis=(1, 3), dtype=np.int32)
+
+        if np.isnan(fill_value):
+            masked_count = np.zeros(sums.shape, dtype=np.int32)
+        else:
+            # Take the fill values back out of the sums rather than copying the data to zero them first
+            masked_count = (blocks == fill_value).sum(axis=(1, 3), dtype=np.int32)
+            sums -= masked_count * int(fill_value)
+    else:
+        # Variables stored unpacked as floats are summed as floats, skipping NaN as well as fill values
+        masked = np.isnan(blocks) if np.isnan(fill_value) else np.isnan(blocks) | (blocks == fill_value)
+        sums = np.where(masked, 0, blocks).sum(axis=(1, 3), dtype=np.float64)
+        masked_count = masked.sum(axis=(1, 3), dtype=np.int32)
+
+    valid_count = precision * precision - masked_count
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(valid_count > 0, sums / valid_count, np.nan)
+
+    scale_factor = 1 if np.isnan(scale_factor) else scale_factor
+    add_offset = 0 if np.isnan(add_offset) else add_offset
+
+    return means * scale_factor + add_offset, masked_count
 
-    # if there are too many masked values return null
-    if np.ma.count_masked(values) > MASK_THRESHOLD:
-        return None
 
-    return np.mean(values)
+def unpack(values, scale_factor, add_offset, fill_value):
+    """Unpack a slab of packed shorts (or unpacked floats) to float64, NaN for fill values"""
 
+    unpacked = values.astype(np.float64)
+    if not np.isnan(fill_value):
+        unpacked[values == fill_value] = np.nan
 
-def process_data(input_filename, day, lat_start, lat_end):
+    scale_factor = 1 if np.isnan(scale_factor) else scale_factor
+    add_offset = 0 if np.isnan(add_offset) else add_offset
+
+    return unpacked * scale_factor + add_offset
+
+
+def parse_bbox(value):
     """
-    Process data over the lat range (lat_start, lat_end)
+    Parse a bounding box given as "south,north,west,east" in degrees
+    e.g. "-60,70,-100,20" for the Atlantic (west can be greater than east to wrap around the 0 meridian)
     """
+    south, north, west, east = [float(part) for part in value.split(',')]
 
-    print(f"{lat_start:<3} to {lat_end:<3}")
+    if not -90 <= south < north <= 90:
+        raise argparse.ArgumentTypeError(f"invalid latitudes in bounding box {value}")
 
-    data = {var: [['-']*TOTAL_LON for _ in range(TOTAL_LAT)] for var in VARIABLES}
+    return (south, north, west, east)
 
-    ctd = Dataset(input_filename, 'r')
 
-    two_metre_temperature = ctd.variables['t2m']
-    mean_sea_level_pressure = ctd.variables['msl']
-    sea_surface_temperature = ctd.variables['sst']
+def grid_window(ctd, resolution, bbox=GLOBE):
+    """
+    Find the part of the source grid to read for an output resolution and bounding box
 
-    for lat in range(lat_start, lat_end):
-        for lon in range(TOTAL_LON):
-            mean_sea_surface_temperature = mean(sea_surface_temperature, day, lat, lon)
+    The blocks line up with the blocks of the whole globe, so the cells of a bounding box are the same as the global ones
 
-            # if sea surface temp is None:
-            # don't care about any other data -> set all to None
-            if mean_sea_surface_temperature is None:
-                for variable in VARIABLES:
-                    data[variable][lat][lon] = None
-            else:
-                data['two_metre_temperature'][lat][lon] = mean(two_metre_temperature, day, lat, lon) - KELVIN
-                data['mean_sea_level_pressure'][lat][lon] = mean(mean_sea_level_pressure, day, lat, lon) / 1000
-                data['sea_surface_temperature'][lat][lon] = mean_sea_surface_temperature - KELVIN
+    returns:
+     - slice of the source latitude rows
+     - list of slices of the source longitude columns (two if the box wraps around the 0 meridian)
+     - number of source points along each side of an output cell
+     - dict of the output cell centre 'lats' and 'lons'
+    """
+
+    latitudes = np.asarray(ctd.variables['latitude'][:], dtype=np.float64)
+    longitudes = np.asarray(ctd.variables['longitude'][:], dtype=np.float64)
+    step = abs(latitudes[1] - latitudes[0])
+
+    precision = int(round(resolution / step))
+    if precision < 1 or not np.isclose(precision * step, resolution):
+        raise ValueError(f"Resolution {resolution} is not a multiple of the source grid step {step}")
+
+    south, north, west, east = bbox
+
+    # Latitudes run north to south
+    rows = np.flatnonzero((latitudes >= south) & (latitudes <= north))
+    row_start = -(-rows[0] // precision) * precision
+    row_stop = row_start + (rows[-1] + 1 - row_start) // precision * precision
+
+    # Longitudes are taken as a range of columns eastwards from the west edge, continuing past the end of the source grid
+    total_columns = len(longitudes)
+    width = (east - west) % 360 or 360
+    column_start = int(np.ceil(round(((west - longitudes[0]) % 360) / step, 6)))
+    column_count = min(int(np.floor(round(width / step, 6))) + 1, total_columns)
+
+    aligned_start = -(-column_start // precision) * precision
+    column_count = (column_count - (aligned_start - column_start)) // precision * precision
+    column_start = aligned_start % total_columns
+
+    if row_stop <= row_start or column_count <= 0:
+        raise ValueError(f"Bounding box {bbox} is smaller than a single {resolution} degree cell")
+
+    column_stop = column_start + column_count
+    columns = [slice(column_start, min(column_stop, total_columns))]
+    if column_stop > total_columns:
+        columns.append(slice(0, column_stop - total_columns))
+
+    # Longitudes of the columns, increasing across the 0 meridian, starting from the west edge
+    lons = longitudes[0] + step * np.arange(column_start, column_stop)
+    lons -= 360 * np.floor((lons[0] - west) / 360)
+
+    grid = {
+        'lats': [round(float(lat), 6) for lat in latitudes[row_start:row_stop].reshape(-1, precision).mean(axis=1)],
+        'lons': [round(float(lon), 6) for lon in lons.reshape(-1, precision).mean(axis=1)],
+    }
+
+    return slice(row_start, row_stop), columns, precision, grid
+
+
+def chunk_rows(variable):
+    """Number of latitude rows in each storage chunk of a (time, lat, lon) variable"""
+
+    chunking = variable.chunking()
+
+    return variable.shape[1] if chunking == 'contiguous' else chunking[1]
+
+
+def set_chunk_cache(variable):
+    """
+    Make the chunk cache of a variable big enough to hold every chunk of one slab of days, so reading
+    the next day from chunks that span several days doesn't decompress them again
+    """
+
+    chunking = variable.chunking()
+    if chunking == 'contiguous':
+        return
+
+    chunk_count = np.prod([-(-length // chunk) for length, chunk in zip(variable.shape[1:], chunking[1:])])
+    size = int(chunk_count * np.prod(chunking) * variable.dtype.itemsize)
+
+    variable.set_var_chunk_cache(size=min(size, CHUNK_CACHE_LIMIT))
+
+
+def read_packed(variable, day, rows, columns):
+    """
+    Read the packed values of a variable for a single day within a window of the source grid,
+    one band of whole storage chunks at a time
+
+    parameters:
+     - variable : (time, lat, lon) NetCDF variable
+     - day : time index
+     - rows : slice of latitude rows
+     - columns : list of slices of longitude columns, joined in order
+    """
+
+    widths = [column.stop - column.start for column in columns]
+    values = np.empty((rows.stop - rows.start, sum(widths)), dtype=variable.dtype)
 
-    return data
+    band = chunk_rows(variable)
+    start = rows.start
+    while start < rows.stop:
+        stop = min((start // band + 1) * band, rows.stop)
 
+        offset = 0
+        for column, width in zip(columns, widths):
+            values[start-rows.start:stop-rows.start, offset:offset+width] = variable[day, start:stop, column]
+            offset += width
 
-def convert_data_for_day(day):
-    print("Converting data for", day)
+        start = stop
 
-    data = {var: [['-']*TOTAL_LON for _ in range(TOTAL_LAT)] for var in VARIABLES}
+    return values
 
-    pool = mp.Pool(mp.cpu_count())
 
-    # Pool.starmap is multithreading magic
-    results = pool.starmap(process_data, [(INPUT_FILENAME, day, i, i+10) for i in range(0, TOTAL_LAT, 10)])
+def source_variables(variables):
+    """The source variables needed to calculate variables (and mask them), each only once"""
 
-    # Merge all the partial results and we're done
-    for result in results:
-        for var in VARIABLES:
-            for lat in range(TOTAL_LAT):
-                for lon in range(TOTAL_LON):
-                    if result[var][lat][lon] != '-':
-                        data[var][lat][lon] = result[var][lat][lon]
+    sources = [MASK_SOURCE]
+    for var in variables:
+        sources += [source for source in REGISTRY[var]['sources'] if source not in sources]
 
-    with open(f"{OUTPUT_DIRECTORY}/{day}.json", 'w') as outfile:
-        json.dump(data, outfile)
+    return sources
+
+
+def parse_variables(value):
+    """Parse a comma separated list of variable names from consts.REGISTRY"""
+
+    variables = value.split(',')
+    for var in variables:
+        if var not in REGISTRY:
+            raise argparse.ArgumentTypeError(f"unknown variable {var}, choose from {', '.join(REGISTRY)}")
+
+    return variables
+
+
+def read_packed_day(ctd, day, sources, rows, columns):
+    """
+    Read the packed values of the source variables for a single day within a window of the source grid
+    (auto mask and scale must be off)
+
+    returns:
+     - dict of source variable -> (packed values, scale_factor, add_offset, _FillValue)
+    """
+
+    packed = {}
+    for name in sources:
+        variable = ctd.variables[name]
+        packed[name] = (
+            read_packed(variable, day, rows, columns),
+            *[getattr(variable, attr, np.nan) for attr in ['scale_factor', 'add_offset', '_FillValue']],
+        )
+
+    return packed
+
+
+def hash_packed_day(packed):
+    """Hash the packed source values of a day, and how to unpack them"""
+
+    arrays = []
+    for (values, *attributes) in packed.values():
+        arrays.append(values)
+        arrays.append(np.array(attributes))
+
+    return hash_arrays(*arrays)
+
+
+def source_key(stat, time, packed_attributes):
+    """
+    Cheap key of a day's source values, from the size and modification time of the source file, the day's time
+    coordinate and how its variables are packed, so an unchanged day can be skipped without reading it
+
+    parameters:
+     - stat : os.stat of the source file
+     - time : the day's value of the time coordinate
+     - packed_attributes : list of (scale_factor, add_offset, _FillValue) of every source variable
+    """
+
+    return hash_arrays(np.array([stat.st_size, stat.st_mtime_ns]), np.array(time), np.array(packed_attributes, dtype=np.float64))
+
+
+def regrid_day(day, packed, precision, variables):
+    """
+    Regrid the packed source values of a single day, averaging precision x precision blocks into each cell,
+    then calculate each variable from the cell means of its sources
+
+    A pointwise variable (see consts.REGISTRY) is calculated from the unpacked source points instead, then averaged
+
+    returns:
+     - dict of variable -> float32 grid
+     - the instrument stats
+    """
+
+    count(CELLS, sum(values.size for (values, *_) in packed.values()))
+
+    with timer('compute', day):
+        # Only the sources of variables calculated from cell means are averaged as they are
+        averaged = [MASK_SOURCE] + [source for var in variables if not REGISTRY[var].get('pointwise') for source in REGISTRY[var]['sources']]
+
+        means = {}
+        masked_counts = {}
+        for name, source in packed.items():
+            if name in averaged:
+                means[name], masked_counts[name] = block_mean(*source, precision)
+
+        # if there are too many masked sea surface temp values:
+        # don't care about any other data -> set all to None
+        null = masked_counts[MASK_SOURCE] > MASK_THRESHOLD * precision * precision
+
+        data = {}
+        for var in variables:
+            entry = REGISTRY[var]
+            if entry.get('pointwise'):
+                points = entry['calculate'](*[unpack(*packed[source]) for source in entry['sources']])
+                values = block_mean(points, np.nan, np.nan, np.nan, precision)[0]
+            else:
+                values = entry['calculate'](*[means[source] for source in entry['sources']])
+            values[null] = np.nan
+            data[var] = values.astype(DTYPE)
+
+    return (data, instrument.take())
+
+
+def write_next(cube, pending, manifest, variables):
+    """Wait for the oldest day still in flight and write it to the cube, so days are written in order"""
+
+    (day, input_hash, key, result) = pending.popleft()
+    (data, day_stats) = result.get()
+
+    instrument.merge(day_stats)
+
+    with timer('write', day):
+        for i, var in enumerate(variables):
+            cube[day, i] = data[var]
+        count(BYTES_WRITTEN, cube[day].nbytes)
+
+    record_day(manifest, day, input_hash, result={'source': key})
+    write_manifest(manifest, force=False)
 
 
 def init():
@@ -114,16 +369,98 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input", help="Input file", default=DEFAULT_INPUT_FILENAME)
     parser.add_argument("-c", "--compress", type=bool, help="Compress", default=True)
+    parser.add_argument("-r", "--resolution", type=float, choices=RESOLUTIONS, help="Output resolution in degrees", default=DEFAULT_RESOLUTION)
+    parser.add_argument("-b", "--bbox", type=parse_bbox, help="Only convert the cells within \"south,north,west,east\" (degrees)", default=GLOBE)
+    parser.add_argument("-v", "--variables", type=parse_variables, help="Comma separated variables to convert", default=VARIABLES)
+    parser.add_argument("-f", "--force", action='store_true', help="Convert every day, even if it hasn't changed since the last run")
+    parser.add_argument("-P", "--profile", help="Comma separated stages to profile with cProfile (read, compute, write), or 'all'")
     args = parser.parse_args()
 
+    start = time.perf_counter()
+
     INPUT_FILENAME = args.input
 
     print("input file", INPUT_FILENAME)
     print("compress", args.compress)
+    print("resolution", args.resolution)
+    print("bounding box", args.bbox)
+    print("variables", ', '.join(args.variables))
 
     init()
 
-    ctd = Dataset(INPUT_FILENAME, 'r')
+    if args.profile:
+        instrument.enable_profiling(args.profile, OUTPUT_DIRECTORY)
 
-    for day in range(len(ctd.variables['time'])):
-        convert_data_for_day(day)
+    ctd = Dataset(INPUT_FILENAME, 'r')
+    days = len(ctd.variables['time'])
+    rows, columns, precision, grid = grid_window(ctd, args.resolution, args.bbox)
+    ctd.close()
+
+    # Keep the days we already converted, and only convert the ones whose source values changed
+    cube, kept = update_cube(OUTPUT_DIRECTORY, range(days), (len(grid['lats']), len(grid['lons'])), args.variables, grid)
+    manifest = read_manifest(OUTPUT_DIRECTORY, {
+        'variables': args.variables,
+        'resolution': args.resolution,
+        'bbox': args.bbox,
+        'mask_threshold': MASK_THRESHOLD,
+        'pointwise': [var for var in args.variables if REGISTRY[var].get('pointwise')],
+    })
+
+    sources = source_variables(args.variables)
+    processes = mp.cpu_count()
+    converted = 0
+
+    # Start the workers before opening the dataset, so they don't inherit its file handles
+    with mp.Pool(processes) as pool:
+        ctd = Dataset(INPUT_FILENAME, 'r')
+        ctd.set_auto_maskandscale(False)
+        for name in sources:
+            set_chunk_cache(ctd.variables[name])
+
+        stat = os.stat(INPUT_FILENAME)
+        times = np.asarray(ctd.variables['time'][:])
+        packed_attributes = [
+            [getattr(ctd.variables[name], attr, np.nan) for attr in ['scale_factor', 'add_offset', '_FillValue']]
+            for name in sources
+        ]
+
+        pending = deque()
+        for day in range(days):
+            key = source_key(stat, times[day], packed_attributes)
+            record = manifest['days'].get(str(day), {}) if day in kept and not args.force else {}
+
+            # Only read and hash the day if the source file changed since it was converted
+            if key == (record.get('result') or {}).get('source'):
+                continue
+
+            with timer('read', day):
+                packed = read_packed_day(ctd, day, sources, rows, columns)
+            count(BYTES_READ, sum(values.nbytes for (values, *_) in packed.values()))
+
+            with timer('hash', day):
+                input_hash = hash_packed_day(packed)
+
+            if input_hash == record.get('input'):
+                record_day(manifest, day, input_hash, result={'source': key})
+                continue
+
+            print("Converting data for", day)
+
+            pending.append((day, input_hash, key, pool.apply_async(regrid_day, (day, packed, precision, args.variables))))
+            converted += 1
+
+            # Don't read further ahead than the workers can keep up with
+            if len(pending) >= processes * IN_FLIGHT_PER_WORKER:
+                write_next(cube, pending, manifest, args.variables)
+
+        ctd.close()
+
+        while pending:
+            write_next(cube, pending, manifest, args.variables)
+
+    cube.flush()
+    write_manifest(manifest)
+
+    print(f"Converted {converted} of {days} days")
+
+    instrument.write_report(OUTPUT_DIRECTORY, 'convert', time.perf_counter() - start)
@@ -1,15 +1,25 @@
-from os import listdir, makedirs
-from os.path import isfile, isdir, join, basename
+from os import makedirs
+from os.path import isfile, isdir, dirname
 import argparse
 import errno
 import json
+import time
 from random import randint
-import multiprocessing as mp
 import numpy as np
-from consts import TOTAL_LAT, TOTAL_LON, VARIABLES, CONVERTED_DIRECTORY, FCLUSTERED_DIRECTORY, DEFAULT_K
+from consts import CONVERTED_DIRECTORY, FCLUSTERED_DIRECTORY, DEFAULT_K
+from kmeans import cluster_prefix_sum, cluster_optimal, cluster_optimal_sweep, split_means, histogram, histogram_counts, histogram_values, HISTOGRAM_BINS
+from utils import day_month, parse_range_list, select_days
+from storage import read_day, write_day, open_cube, update_cube, read_metadata, read_grid, prepare_day_directory
+from manifest import hash_arrays, read_manifest, write_manifest, is_fresh, record_day, day_result
+from workers import run
+import instrument
+from instrument import timer, count, counter_group, CELLS, ITERATIONS, TIES, BYTES_READ, BYTES_WRITTEN
 
 DEBUG = False
 
+CODEBOOK_FILENAME = 'codebook.json'
+CODEBOOK_CHUNK_DAYS = 16    # days read at a time when fitting or labelling with a codebook
+
 
 def unique_array(arr):
     return len(arr) == len(set(arr))
@@ -26,6 +36,7 @@ def choose_random_duplicate(clustermeans, index, backwards):
 
         # If we have duplicates, randomly choose one to assign the datapoint to
         if duplicate_count > 0:
+            count(TIES)
             return randint(index, index + duplicate_count)
         else:
             return index
@@ -37,6 +48,7 @@ def choose_random_duplicate(clustermeans, index, backwards):
 
         # If we have duplicates, randomly choose one to assign the datapoint to
         if duplicate_count > 0:
+            count(TIES)
             return randint(index - duplicate_count - 1, index-1)
         else:
             return index-1
@@ -61,6 +73,7 @@ def closest_search_naive(datapoint, clustermeans):
 
     # If ind_diff == indm1_diff then the datapoint is *exactly* halfway between the two
     if ind_diff == indm1_diff:
+        count(TIES)
         return randint(index-1, index)
     elif ind_diff < indm1_diff:
         return choose_random_duplicate(clustermeans, index, False)
@@ -68,6 +81,50 @@ def closest_search_naive(datapoint, clustermeans):
         return choose_random_duplicate(clustermeans, index, True)
 
 
+def assign_clusters(data, means, rng):
+    """
+    Vectorized closest_search_naive: find the closest cluster for every data point at once
+
+    Data points exactly halfway between two means, or closest to a mean shared by several clusters,
+    are assigned randomly using rng (seed it for reproducible labels)
+
+    parameters:
+     - data : array of datapoints, NaN for missing cells
+     - means : sorted cluster means
+     - rng : numpy random Generator used to break ties
+
+    returns:
+     - array of cluster labels with the same shape as data (-1 for missing cells)
+    """
+
+    labels = np.full(data.shape, -1)
+    valid = ~np.isnan(data)
+    datapoints = data[valid]
+
+    # Duplicate means are collapsed into one, and a cluster is chosen randomly among them afterwards
+    unique_means, first_index, duplicate_count = np.unique(means, return_index=True, return_counts=True)
+
+    # A datapoint belongs to the i'th mean if it falls between the (i-1)'th and i'th midpoints
+    midpoints = (unique_means[:-1] + unique_means[1:]) / 2
+    index = np.searchsorted(midpoints, datapoints, side='right')
+
+    # If a datapoint is *exactly* on a midpoint, randomly choose between the two means
+    if len(midpoints) > 0:
+        halfway = np.flatnonzero((index > 0) & (datapoints == midpoints[np.maximum(index-1, 0)]))
+        index[halfway] -= rng.integers(0, 2, len(halfway))
+
+    cluster = first_index[index]
+
+    duplicates = np.flatnonzero(duplicate_count[index] > 1)
+    cluster[duplicates] += rng.integers(0, duplicate_count[index[duplicates]])
+
+    count(TIES, len(duplicates) + (len(halfway) if len(midpoints) > 0 else 0))
+
+    labels[valid] = cluster
+
+    return labels
+
+
 def closest_search_no_dups(datapoints, k, means, cluster_sums, cluster_count):
     """
     closest_search_no_dups
@@ -84,6 +141,10 @@ def closest_search_no_dups(datapoints, k, means, cluster_sums, cluster_count):
     cluster_sums = cluster_sums.copy()
     cluster_count = cluster_count.copy()
 
+    # A single cluster has no dividers to move
+    if k == 1:
+        return (cluster_sums, cluster_count, 0)
+
     dividerpos = [0]*(k-1)
 
     dividerpos[0] = cluster_count[0]
@@ -143,13 +204,15 @@ def closest_search_no_dups(datapoints, k, means, cluster_sums, cluster_count):
     return (cluster_sums, cluster_count, n)
 
 
-def cluster_fast_dataset(dataset, cluster_count):
+def cluster_fast_dataset(dataset, cluster_count, means=None):
     """
     cluster_fast_dataset
 
     parameters:
      - dataset : dataset to cluster
      - cluster_count : TODO 
+     - means : sorted initial means, e.g. the previous day's (linear interpolation between min and max if None),
+               the first assignment places their dividers with a binary search each rather than visiting every datapoint
 
     returns:
      - updated cluster_means, cluster_sums and cluster_counts
@@ -163,17 +226,30 @@ def cluster_fast_dataset(dataset, cluster_count):
 
     new_means = np.zeros(cluster_count)
 
-    # Simple linear interpolation
-    for i in range(cluster_count):
-        new_means[i] = (i/cluster_count)*maximum + (1-i/cluster_count)*minimum
-
-    # Get each datapoint in its respective cluster
-    cluster_counts = [0]*cluster_count
-    cluster_sums = [0]*cluster_count
-    for i in range(len(dataset)):
-        index = closest_search_naive(dataset[i], new_means)
-        cluster_counts[index] += 1
-        cluster_sums[index] += dataset[i]
+    if means is not None:
+        # Warm start
+        new_means = np.array(means, dtype=np.float64)
+    else:
+        # Simple linear interpolation
+        for i in range(cluster_count):
+            new_means[i] = (i/cluster_count)*maximum + (1-i/cluster_count)*minimum
+
+    if means is not None and unique_array(new_means):
+        # Place every divider of the previous day at once, at the first datapoint >= the midpoint between two means
+        # (the same side closest_search_no_dups puts them on)
+        dividers = np.searchsorted(dataset, (new_means[:-1] + new_means[1:]) / 2, side='left')
+        bounds = np.concatenate(([0], dividers, [len(dataset)]))
+        prefix = np.concatenate(([0], np.cumsum(dataset, dtype=np.float64)))
+        cluster_counts = np.diff(bounds).tolist()
+        cluster_sums = (prefix[bounds[1:]] - prefix[bounds[:-1]]).tolist()
+    else:
+        # Get each datapoint in its respective cluster
+        cluster_counts = [0]*cluster_count
+        cluster_sums = [0]*cluster_count
+        for i in range(len(dataset)):
+            index = closest_search_naive(dataset[i], new_means)
+            cluster_counts[index] += 1
+            cluster_sums[index] += dataset[i]
 
     # If there is an empty cluster (or multiple) just get rid of it.
     # Believe it or not, this is the "industry standard" approach.
@@ -188,7 +264,7 @@ def cluster_fast_dataset(dataset, cluster_count):
     for i in range(cluster_count):
         new_means[i] = cluster_sums[i] / cluster_counts[i]
 
-    means = np.zeros(cluster_count)
+    means = np.full(cluster_count, np.nan)
 
     # Now do iterations
     x_sum = 0
@@ -239,10 +315,35 @@ def cluster_fast_dataset(dataset, cluster_count):
     return (new_means, iters, x_sum)
 
 
-def fcluster(data, k):
+# 1-D k-means engines, selectable with --engine
+ENGINES = {
+    'fast': cluster_fast_dataset,
+    'prefix': cluster_prefix_sum,
+    'optimal': cluster_optimal,
+}
+DEFAULT_ENGINE = 'fast'
+WEIGHTED_ENGINES = ['prefix', 'optimal']       # engines that can cluster a histogram
+
+
+def fcluster(data, k, seed=None, engine=DEFAULT_ENGINE, bins=None, means=None):
     """
     fcluster
 
+    parameters:
+     - data : 2d grid to cluster, NaN for missing cells
+     - k : number of clusters
+     - seed : seed for breaking ties between clusters (random if None)
+     - engine : name of the 1-D k-means engine in ENGINES
+     - bins : if set, cluster a histogram with this many bins instead of the sorted data (WEIGHTED_ENGINES only)
+     - means : k sorted means to start from, e.g. the previous day's converged means (ignored by the optimal engine)
+
+    returns:
+     - grid with each cell replaced by the mean of its cluster
+     - min/max of the data
+     - grid of cluster labels (-1 for missing cells)
+     - converged cluster means
+     - number of iterations
+
     algorithm overview:
         1: Choose k random points, assign the mean of each cluster to the value of its single data point
         2: Assign each data point its cluster based on which mean is closest
@@ -253,19 +354,15 @@ def fcluster(data, k):
     # 1: Choose k random points (sea surface temperature)
     # data = full_data[VARIABLES[4]]
 
-    # Use O(n log n) time to determine cluster sums and cluster counts
-    data_ordered = np.zeros(TOTAL_LAT * TOTAL_LON)
-    data_ordered.fill(-32767)
+    # If empty clusters were dropped from the starting means, start from scratch instead of continuing with fewer clusters
+    if means is not None and len(means) != k:
+        means = None
 
-    for i in range(TOTAL_LAT):
-        for j in range(TOTAL_LON):
-            if data[i][j] is not None:
-                data_ordered[i*TOTAL_LON+j] = data[i][j]
+    (values, data_ordered, weights) = order_data(data, bins)
+    (means, iters, average_x) = run_engine(engine, data_ordered, k, weights, means)
 
-    data_ordered.sort()
-    data_ordered = data_ordered[np.searchsorted(data_ordered, -32766):]
-
-    (means, iters, average_x) = cluster_fast_dataset(data_ordered, k)
+    count(CELLS, len(values))
+    count(ITERATIONS, iters)
 
     # We now have the final clustering - display the means of each cluster!
     if DEBUG:
@@ -274,49 +371,281 @@ def fcluster(data, k):
         print(average_x)
 
     # For each data point, find its cluster and make the value of the data point equal to the mean of the cluster.
-    for i in range(TOTAL_LAT):
-        for j in range(TOTAL_LON):
-            if data[i][j] is None:
-                continue
-            cluster = closest_search_naive(data[i][j], means)
-            data[i][j] = means[cluster]
+    (data, labels) = label_data(data, means, seed)
 
     # Since data is ordered, we can get min/max like this
-    min = data_ordered[0]
-    max = data_ordered[len(data_ordered)-1]
+    min = np.min(values) if bins else data_ordered[0]
+    max = np.max(values) if bins else data_ordered[len(data_ordered)-1]
+
+    return (data, min, max, labels, means, iters)
+
+
+def fcluster_sweep(data, ks, seed=None, engine=DEFAULT_ENGINE, bins=None):
+    """
+    Run fcluster for every k in ks, sorting (or binning) the data only once (see sweep_engine)
+
+    returns:
+     - dict of k -> the result of fcluster
+    """
+
+    (values, data_ordered, weights) = order_data(data, bins)
+
+    min = np.min(values) if bins else data_ordered[0]
+    max = np.max(values) if bins else data_ordered[len(data_ordered)-1]
+
+    ks = sorted(ks)
+    engine_results = sweep_engine(engine, data_ordered, ks, weights)
+
+    count(CELLS, len(values))
+
+    results = {}
+    for k, (means, iters, _) in zip(ks, engine_results):
+        with counter_group(k):
+            count(ITERATIONS, iters)
+            (clustered, labels) = label_data(data, means, seed)
+        results[k] = (clustered, min, max, labels, means, iters)
+
+    return results
+
+
+def sweep_engine(engine, data_ordered, ks, weights=None):
+    """
+    Run a 1-D k-means engine on ordered data for every k in (sorted) ks
+
+    The optimal engine fills its dynamic program once for the largest k, other engines
+    start each k from the previous k's means with the worst cluster split in two
+
+    returns:
+     - a list of (means, iterations, operations) for each k
+    """
+
+    if engine == 'optimal':
+        return cluster_optimal_sweep(data_ordered, ks, weights)
+
+    engine_results = []
+    means = None
+    for k in ks:
+        if means is not None:
+            means = split_means(data_ordered, means, k, weights)
+            if len(means) != k:
+                means = None
+
+        with counter_group(k):
+            engine_results.append(run_engine(engine, data_ordered, k, weights, means))
+        means = engine_results[-1][0]
 
-    return (data, min, max)
+    return engine_results
 
 
-def cluster_file(filename, k, output_dir):
+def order_data(data, bins=None):
     """
-    Given a filename and k value, run fcluster on the file and write to output_dir
+    Collect the non-missing values of a grid, and either sort them or bin them into a histogram
 
-    returns the min/max values for each variable
+    returns:
+     - the non-missing values
+     - the sorted values (or sorted bin values)
+     - the bin weights (None if not binned)
+    """
+
+    values = data[~np.isnan(data)]
+
+    if bins:
+        # Use O(n) time to bin the data, then the cost of each iteration only depends on the number of bins
+        (data_ordered, weights) = histogram(values, bins)
+        return (values, data_ordered, weights)
+
+    # Use O(n log n) time to determine cluster sums and cluster counts
+    return (values, np.sort(values), None)
+
+
+def run_engine(engine, data_ordered, k, weights=None, means=None):
+    """Run a 1-D k-means engine on ordered data, returning (means, iterations, operations)"""
+
+    if weights is not None:
+        return ENGINES[engine](data_ordered, k, weights=weights, means=means)
+
+    return ENGINES[engine](data_ordered, k, means=means)
+
+
+def label_data(data, means, seed=None):
+    """
+    Replace every cell of a grid with the mean of its closest cluster
+
+    returns:
+     - the clustered grid
+     - grid of cluster labels (-1 for missing cells)
+    """
+
+    labels = assign_clusters(data, means, np.random.default_rng(seed))
+
+    return (np.where(labels >= 0, means[labels], np.nan), labels)
+
+
+def cluster_file(path, index, k, output_dir, seed=None, engine=DEFAULT_ENGINE, bins=None, means=None):
+    """
+    Given a day file (or a cube directory and day index) and k value, run fcluster on the day and write to output_dir
+
+    index is None for a day file, which is always written to its own file (see storage.write_day)
+
+    means optionally holds the starting means for each variable
+
+    returns:
+     - the min/max values for each variable
+     - the converged means for each variable
+     - the number of iterations for each variable
     """
     if DEBUG:
-        print('Clustering', filename)
+        print('Clustering', path, index)
 
-    with open(filename, 'r') as my_file:
-        data = json.load(my_file)
+    with timer('read', index):
+        day, data = read_day(path, index)
+        data = {var: np.array(grid, dtype=np.float64) for var, grid in data.items()}
 
-    ranges = {}     # keep track of min/max values for each variable
+    ranges = {}         # keep track of min/max values for each variable
+    new_means = {}
+    iterations = {}
 
-    for variable in VARIABLES:
-        data[variable], min, max = fcluster(data[variable], k)
-        ranges[variable] = (min, max)
+    with timer('compute', index):
+        for variable in data:
+            data[variable], min, max, _, new_means[variable], iterations[variable] = fcluster(
+                data[variable], k, seed, engine, bins, (means or {}).get(variable)
+            )
+            ranges[variable] = (float(min), float(max))
 
-    # Now write this to a new data json so it can be mapped.
-    with open(f"{output_dir}/{basename(filename)}", 'w') as outfile:
-        json.dump(data, outfile)
+    # Now write this to the output so it can be mapped.
+    with timer('write', index):
+        write_day(output_dir, index, day, data)
 
-    return ranges
+    return (ranges, new_means, iterations)
+
+
+def sweep_file(path, index, ks, output_dirs, seed=None, engine=DEFAULT_ENGINE, bins=None):
+    """
+    Given a day file (or a cube directory and day index), run fcluster_sweep on the day
+    and write the result for each k to output_dirs[k]
+
+    index is None for a day file, which is always written to its own file (see storage.write_day)
+
+    returns:
+     - dict of k -> the result of cluster_file for that k
+    """
+    if DEBUG:
+        print('Clustering', path, index, ks)
+
+    with timer('read', index):
+        day, data = read_day(path, index)
+        data = {var: np.array(grid, dtype=np.float64) for var, grid in data.items()}
+
+    clustered = {k: ({}, {}, {}) for k in ks}
+    outputs = {k: {} for k in ks}
+
+    with timer('compute', index):
+        for variable, grid in data.items():
+            sweep = fcluster_sweep(grid, ks, seed, engine, bins)
+
+            for k, (output, min, max, _, means, iters) in sweep.items():
+                outputs[k][variable] = output
+                clustered[k][0][variable] = (float(min), float(max))
+                clustered[k][1][variable] = means
+                clustered[k][2][variable] = iters
+
+    with timer('write', index):
+        for k in ks:
+            with counter_group(k):
+                write_day(output_dirs[k], index, day, outputs[k])
+
+    return clustered
+
+
+def cluster_grid(grid, means, k, seed=None, engine=DEFAULT_ENGINE, bins=None):
+    """
+    Worker function (see workers.run_task): run fcluster on a single grid, starting from means if given
+
+    returns:
+     - dict of k -> clustered grid
+     - dict of k -> (min, max, means, iterations)
+     - the converged means, so the next day in a chain starts from them
+    """
+
+    (clustered, min, max, _, means, iters) = fcluster(grid, k, seed, engine, bins, means)
+
+    return ({k: clustered}, {k: (min, max, means, iters)}, means)
+
+
+def sweep_grid(grid, state, ks, seed=None, engine=DEFAULT_ENGINE, bins=None):
+    """
+    Worker function (see workers.run_task): run fcluster_sweep on a single grid
+
+    returns:
+     - dict of k -> clustered grid
+     - dict of k -> (min, max, means, iterations)
+     - no state, every day is swept on its own
+    """
+
+    sweep = fcluster_sweep(grid, ks, seed, engine, bins)
+
+    outputs = {k: clustered for k, (clustered, _, _, _, _, _) in sweep.items()}
+    results = {k: (min, max, means, iters) for k, (_, min, max, _, means, iters) in sweep.items()}
+
+    return (outputs, results, None)
+
+
+def summarize_day(day_results, variables, k):
+    """
+    Summarize the worker results for k on a single day as the (ranges, means, iterations) returned by cluster_file,
+    without the means so it can be stored in the manifest
+    """
+
+    ranges, iterations = {}, {}
+
+    for variable, result in zip(variables, day_results):
+        (min, max, _, iters) = result[k]
+        ranges[variable] = (float(min), float(max))
+        iterations[variable] = int(iters)
+
+    return (ranges, None, iterations)
+
+
+def stale_chains(chains, stale):
+    """
+    Keep the chains with a stale day in them, and drop the rest
+
+    Every day in a chain depends on the days before it, so a chain is run again as a whole
+    """
+
+    return [chain for chain in chains if any(index in stale for index in chain)]
+
+
+def split_chains(days, chains):
+    """
+    Split the indices of the (ordered) days into chains of consecutive days
+
+    chains is either a number of equal length chains, or 'month' for one chain per month
+    """
+
+    if chains == 'month':
+        months = [day_month(day) for day in days]
+        return [[i for i in range(len(days)) if months[i] == month] for month in sorted(set(months))]
+
+    return [list(chain) for chain in np.array_split(range(len(days)), int(chains)) if len(chain) > 0]
+
+
+def write_iterations(output_dir, days, results):
+    """Write and print the number of iterations each variable took to converge on each day"""
+
+    iterations = {str(day): {var: int(iters) for var, iters in result[2].items()} for day, result in zip(days, results)}
+
+    for day, counts in iterations.items():
+        print(f"{day:>3}: {counts}")
+
+    with open(f"{output_dir}/iterations.json", 'w') as outfile:
+        json.dump(iterations, outfile)
 
 
 def get_variable_ranges(results):
-    """Calculate the max/min value of each clustered variable"""
+    """Calculate the max/min value of each clustered variable, skipping days without any data (NaN)"""
 
-    ranges = {var: {'min': [], 'max': []} for var in VARIABLES}
+    ranges = {var: {'min': [], 'max': []} for var in results[0]}
 
     for result in results:
         for var, val in result.items():
@@ -325,11 +654,144 @@ def get_variable_ranges(results):
             ranges[var]['max'].append(local_max)
 
     for var, val in ranges.items():
-        ranges[var] = (min(val['min']), max(val['max']))
+        ranges[var] = (float(np.nanmin(val['min'])), float(np.nanmax(val['max'])))
 
     return ranges
 
 
+def fit_codebooks(cube, variables, ks, engine, bins=HISTOGRAM_BINS, indices=None):
+    """
+    Fit one set of cluster means (a codebook) per variable and k over every day of a cube (or the days at indices)
+
+    Each variable is binned into a histogram a few days at a time, so the whole year is never held in memory,
+    and the weighted engine clusters the bins
+
+    parameters:
+     - cube : cube of shape (day, variable, lat, lon), e.g. memory-mapped
+     - variables : the variables of the cube, in order
+     - ks : k values to fit
+     - engine : name of a 1-D k-means engine in WEIGHTED_ENGINES
+     - bins : number of histogram bins
+     - indices : indices of the days to fit on, every day if None
+
+    returns:
+     - dict of k -> codebook, a json-able dict with the 'means', 'iterations' and (min, max) 'ranges' of each variable
+    """
+
+    ks = sorted(ks)
+    indices = list(range(len(cube))) if indices is None else list(indices)
+    codebooks = {k: {'k': k, 'engine': engine, 'bins': bins, 'days': len(indices), 'means': {}, 'iterations': {}, 'ranges': {}} for k in ks}
+
+    for i, var in enumerate(variables):
+        with timer('read'):
+            minimum, maximum = np.inf, -np.inf
+            for start in range(0, len(indices), CODEBOOK_CHUNK_DAYS):
+                values = cube[indices[start:start+CODEBOOK_CHUNK_DAYS], i]
+                minimum = min(minimum, np.nanmin(values))
+                maximum = max(maximum, np.nanmax(values))
+
+        minimum, maximum = float(minimum), float(maximum)
+        width = (maximum - minimum) / bins
+
+        counts = np.zeros(bins, dtype=np.int64)
+        sums = np.zeros(bins)
+        for start in range(0, len(indices), CODEBOOK_CHUNK_DAYS):
+            with timer('read'):
+                values = cube[indices[start:start+CODEBOOK_CHUNK_DAYS], i]
+                values = values[~np.isnan(values)]
+
+            with timer('fit'):
+                (chunk_counts, chunk_sums) = histogram_counts(values, minimum, width, bins)
+                counts += chunk_counts
+                sums += chunk_sums
+
+            count(CELLS, len(values))
+
+        with timer('fit'):
+            (data_ordered, weights) = histogram_values(counts, sums)
+            engine_results = sweep_engine(engine, data_ordered, ks, weights)
+
+        for k, (means, iters, _) in zip(ks, engine_results):
+            with counter_group(k):
+                count(ITERATIONS, iters)
+
+            codebooks[k]['means'][var] = [float(mean) for mean in means]
+            codebooks[k]['iterations'][var] = int(iters)
+            codebooks[k]['ranges'][var] = (minimum, maximum)
+
+    return codebooks
+
+
+def label_codebook(data, means, seed=None):
+    """
+    Replace every cell of a day's grid with the closest of the sorted means of a codebook
+
+    Ties (cells exactly halfway between two means) are broken randomly with the seed, the same way as when clustering
+    each day on its own (see assign_clusters)
+    """
+
+    return label_data(data, np.asarray(means), seed)[0]
+
+
+def label_days(input_cube, output_cube, indices, variables, codebook, rows=None, seed=None):
+    """
+    Label the days at indices of the input cube with a codebook (see fit_codebooks), a few days at a time,
+    and write them to the same days of the output cube (or to rows, if it only holds some of the days)
+
+    Each day's ties are broken with its own generator seeded with seed, so its labels don't depend on which
+    other days are labelled with it
+    """
+
+    rows = indices if rows is None else rows
+
+    for start in range(0, len(indices), CODEBOOK_CHUNK_DAYS):
+        chunk = indices[start:start+CODEBOOK_CHUNK_DAYS]
+        chunk_rows = rows[start:start+CODEBOOK_CHUNK_DAYS]
+
+        for i, var in enumerate(variables):
+            with timer('read'):
+                values = input_cube[chunk, i]
+                count(BYTES_READ, values.nbytes)
+
+            with timer('compute'):
+                clustered = np.stack([label_codebook(grid, codebook['means'][var], seed) for grid in values])
+                count(CELLS, np.count_nonzero(~np.isnan(values)))
+
+            with timer('write'):
+                output_cube[chunk_rows, i] = clustered
+                count(BYTES_WRITTEN, values.nbytes)
+
+    with timer('write'):
+        output_cube.flush()
+
+
+def label_file(path, index, codebook, output_dir, seed=None):
+    """
+    Given a day file (or a cube directory and day index), label the day with a codebook and write to output_dir
+
+    index is None for a day file, which is always written to its own file (see storage.write_day)
+    """
+
+    with timer('read', index):
+        day, data = read_day(path, index)
+
+    with timer('compute', index):
+        data = {var: label_codebook(grid, codebook['means'][var], seed) for var, grid in data.items()}
+
+    with timer('write', index):
+        write_day(output_dir, index, day, data)
+
+
+def write_codebook(output_dir, codebook):
+    with open(f"{output_dir}/{CODEBOOK_FILENAME}", 'w') as outfile:
+        json.dump(codebook, outfile)
+
+
+def read_codebook(path):
+    with open(path, 'r') as my_file:
+        return json.load(my_file)
+
+
 def init(output_dir):
     """Initialization for the algorithm"""
 
@@ -343,22 +805,76 @@ def init(output_dir):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input', help='Input JSON file')
+    parser.add_argument('-i', '--input', help='Input day file or cube directory')
     parser.add_argument('-o', '--output', help='Output subdirectory')
-    parser.add_argument('-k', '--k', help='k value', default=DEFAULT_K)
+    parser.add_argument('-k', '--k', help='k value, or a list/range of k values to sweep (e.g. 5-10 or 5,7,9)', default=DEFAULT_K)
+    parser.add_argument('-s', '--seed', type=int, help='Seed for breaking ties between clusters', default=None)
+    parser.add_argument('-e', '--engine', choices=ENGINES.keys(), help='1-D k-means engine', default=DEFAULT_ENGINE)
+    parser.add_argument('-b', '--bins', type=int, help='Cluster a histogram with this many bins instead of the sorted data', default=None)
+    parser.add_argument('-w', '--warm-start', action='store_true', help="Start each day from the previous day's means")
+    parser.add_argument('-c', '--chains', help="Number of chains of consecutive days to warm start in parallel, or 'month'", default='month')
+    parser.add_argument('-g', '--global', dest='global_codebook', action='store_true',
+                        help='Fit one set of means per variable over every day (a codebook), and label every day with it')
+    parser.add_argument('--codebook', help='Label every day with the means in this codebook.json instead of clustering')
+    parser.add_argument('-d', '--days', help="Days to cluster: day numbers/ranges, 'first-of-month' or 'every:<n>' (every day if not set)")
+    parser.add_argument('-f', '--force', action='store_true', help="Cluster every day, even if it hasn't changed since the last run")
+    parser.add_argument('-P', '--profile', help="Comma separated stages to profile with cProfile (read, fit, compute, write), or 'all'")
     args = parser.parse_args()
 
+    start = time.perf_counter()
+
+    if (args.bins or args.global_codebook) and args.engine not in WEIGHTED_ENGINES:
+        parser.error(f"--bins and --global require one of the {', '.join(WEIGHTED_ENGINES)} engines")
+
+    ks = parse_range_list(args.k)
+
+    if args.warm_start and len(ks) > 1:
+        parser.error("--warm-start only supports a single k value")
+
+    if args.warm_start and (args.global_codebook or args.codebook):
+        parser.error("--warm-start can't be used with a codebook")
+
+    # The k of an existing codebook is already fixed
+    codebooks = None
+    if args.codebook:
+        codebook = read_codebook(args.codebook)
+        codebooks = {codebook['k']: codebook}
+        ks = [codebook['k']]
+
     # If we specify a custom output dir, place it inside the default output directory
     output_dir = f"{FCLUSTERED_DIRECTORY}/{args.output}" if args.output else FCLUSTERED_DIRECTORY
 
-    init(output_dir)
+    # When sweeping over several k values, each one is written to its own k=<k> subdirectory
+    output_dirs = {k: f"{output_dir}/k={k}" if len(ks) > 1 else output_dir for k in ks}
 
-    args.k = int(args.k)
+    for k_output_dir in output_dirs.values():
+        init(k_output_dir)
+
+    if args.profile:
+        instrument.enable_profiling(args.profile, output_dir)
 
     # If input is a single file, easy case
     if args.input and isfile(args.input):
         print('Cluster', args.input, output_dir)
-        cluster_file(args.input, args.k, output_dir)
+
+        if args.global_codebook:
+            parser.error("--global fits the codebook over every day of a cube directory, use --codebook to label a single day")
+
+        # The day is written to its own <day>.npy file, next to (never into) any cube already in the output directory
+        for k_output_dir in output_dirs.values():
+            try:
+                prepare_day_directory(k_output_dir, read_metadata(dirname(args.input) or '.')['variables'], read_grid(args.input))
+            except ValueError as e:
+                parser.error(str(e))
+
+        if codebooks:
+            label_file(args.input, None, codebooks[ks[0]], output_dir, args.seed)
+        elif len(ks) > 1:
+            sweep_file(args.input, None, ks, output_dirs, args.seed, args.engine, args.bins)
+        else:
+            cluster_file(args.input, None, ks[0], output_dir, args.seed, args.engine, args.bins)
+
+        instrument.write_report(output_dir, 'fcluster', time.perf_counter() - start, output_dirs if len(ks) > 1 else None)
         exit()
 
     # Since input isn't a single file, it's either
@@ -366,16 +882,112 @@ if __name__ == '__main__':
     #   b) not specified
     input_dir = args.input if args.input and isdir(args.input) else CONVERTED_DIRECTORY
 
-    print('Cluster files in', input_dir)
+    print('Cluster days in', input_dir)
+
+    # The clustered days are written into a cube with the same layout as the input, keeping the days clustered before
+    input_cube, metadata = open_cube(input_dir)
+    days = metadata['days']
+
+    # Only the selected days are clustered, and the output cube only holds those days
+    try:
+        selected = select_days(days, args.days)
+    except ValueError as e:
+        parser.error(f"Invalid --days: {e}")
+
+    selected_days = [days[index] for index in selected]
+    rows = {index: row for row, index in enumerate(selected)}
+
+    if args.global_codebook or codebooks:
+        # Only the fit sees every day, labelling the days with the shared codebook is a single pass over them
+        if args.global_codebook:
+            codebooks = fit_codebooks(input_cube, metadata['variables'], ks, args.engine, args.bins or HISTOGRAM_BINS, selected)
+
+        for var in metadata['variables']:
+            if var not in codebooks[ks[0]]['means']:
+                parser.error(f"The codebook has no means for {var}")
+
+        input_hashes = {index: hash_arrays(input_cube[index]) for index in selected}
+
+        for k, codebook in codebooks.items():
+            output_cube, kept = update_cube(output_dirs[k], selected_days, input_cube.shape[2:], metadata['variables'], read_grid(input_dir))
+            manifest = read_manifest(output_dirs[k], {'variables': metadata['variables'], 'codebook': codebook['means'], 'seed': args.seed})
+
+            stale = [
+                index for index in selected
+                if args.force or not (days[index] in kept and is_fresh(manifest, days[index], input_hashes[index]))
+            ]
+            print(f"Labelling {len(stale)} of {len(selected)} days with the k={k} codebook")
+
+            with counter_group(k):
+                label_days(input_cube, output_cube, stale, metadata['variables'], codebook, [rows[index] for index in stale], args.seed)
+
+            for index in stale:
+                record_day(manifest, days[index], input_hashes[index])
+            write_manifest(manifest)
+
+            write_codebook(output_dirs[k], codebook)
+
+            # Every day shares the codebook, so the ranges are the ones it was fit on
+            with open(f"{output_dirs[k]}/range.json", 'w') as outfile:
+                json.dump(codebook['ranges'], outfile)
+
+        instrument.write_report(output_dir, 'fcluster', time.perf_counter() - start, output_dirs if len(ks) > 1 else None)
+        exit()
+
+    kept = {}
+    manifests = {}
+    for k, k_output_dir in output_dirs.items():
+        _, kept[k] = update_cube(k_output_dir, selected_days, input_cube.shape[2:], metadata['variables'], read_grid(input_dir))
+        manifests[k] = read_manifest(k_output_dir, {
+            'variables': metadata['variables'],
+            'k': k,
+            'seed': args.seed,
+            'engine': args.engine,
+            'bins': args.bins,
+            'warm_start': args.chains if args.warm_start else False,
+        })
+
+    # Only cluster the days whose input changed since the last run (or that were never clustered)
+    input_hashes = {index: hash_arrays(input_cube[index]) for index in selected}
+    stale = {
+        index for index in selected
+        if args.force or not all(days[index] in kept[k] and is_fresh(manifests[k], days[index], input_hashes[index]) for k in ks)
+    }
+
+    # Days within a chain are warm started in order (from the previous selected day), otherwise every day is clustered on its own
+    if args.warm_start:
+        chains = stale_chains([[selected[i] for i in chain] for chain in split_chains(selected_days, args.chains)], stale)
+    else:
+        chains = [[index] for index in sorted(stale)]
+
+    print(f"Clustering {sum(len(chain) for chain in chains)} of {len(selected)} days")
+
+    def on_day(index, day_results):
+        """Record each day in the manifests as soon as it's written, so an interrupted run can pick up from here"""
+
+        for k in ks:
+            record_day(manifests[k], days[index], input_hashes[index], result=summarize_day(day_results, metadata['variables'], k))
+            write_manifest(manifests[k], force=False)
+
+    if len(ks) > 1:
+        # Each day is only read and sorted once for all k values
+        run(sweep_grid, input_dir, output_dirs, (ks, args.seed, args.engine, args.bins), chains, on_day=on_day, rows=rows)
+    else:
+        run(cluster_grid, input_dir, output_dirs, (ks[0], args.seed, args.engine, args.bins), chains, on_day=on_day, rows=rows)
+
+    for manifest in manifests.values():
+        write_manifest(manifest)
+
+    # Summaries are rebuilt from the manifests, which hold every day whether it was clustered in this run or before
+    results = {k: [day_result(manifests[k], day) for day in selected_days] for k in ks}
 
-    # Collect all the .json files in input_dir
-    files = [f"{input_dir}/{f}" for f in listdir(input_dir) if isfile(join(input_dir, f)) if f.endswith('json')]
+    for k, k_results in results.items():
+        write_iterations(output_dirs[k], selected_days, k_results)
 
-    pool = mp.Pool(mp.cpu_count())
-    results = pool.starmap(cluster_file, [(file, args.k, output_dir) for file in files])
+        # Calculate min/max across the clusters for each variable
+        ranges = get_variable_ranges([result[0] for result in k_results])
 
-    # Calculate min/max across the clusters for each variable
-    ranges = get_variable_ranges(results)
+        with open(f"{output_dirs[k]}/range.json", 'w') as outfile:
+            json.dump(ranges, outfile)
 
-    with open(f"{output_dir}/range.json", 'w') as outfile:
-        json.dump(ranges, outfile)
+    instrument.write_report(output_dir, 'fcluster', time.perf_counter() - start, output_dirs if len(ks) > 1 else None)
@@ -1,32 +1,48 @@
-from os import listdir, makedirs
-from os.path import isfile, isdir, join, basename
+from os import makedirs, stat
+from os.path import isfile, isdir, dirname
 import errno
 import json
 import argparse
+import time
 import numpy as np
 import multiprocessing as mp
 import matplotlib.pyplot as plt
 
-from consts import TOTAL_LAT, TOTAL_LON, CONVERTED_DIRECTORY, VISUALS_DIRECTORY, DEG, DEFAULT_K
-from utils import get_units, get_english_variable_name, day_str
+from consts import CONVERTED_DIRECTORY, VISUALS_DIRECTORY, DEG, DEFAULT_K
+from utils import get_units, get_english_variable_name, day_str, select_days
+from storage import read_day, read_grid, read_metadata, open_cube, CUBE_FILENAME
+from manifest import hash_arrays, read_manifest, write_manifest, is_fresh, record_day
+import instrument
+from instrument import timer, count, count_file, BYTES_READ, BYTES_WRITTEN
+from workers import TASKS_PER_WORKER
+from video import capture, write_video, DEFAULT_FPS, DEFAULT_DPI
 
 DEBUG = False
 
-LON = 185
+LON = 185.375                   # longitude of the transect, the nearest column of the grid is plotted
+TRANSECTS_FILENAME = 'transects.json'
+TRANSECT_SEPARATION = 30        # degrees between automatically chosen transects
+COUNT_CHUNK_DAYS = 16           # days read at a time when counting the cells with data
 
 INPUT_DIRECTORY = CONVERTED_DIRECTORY
 OUTPUT_DIRECTORY = VISUALS_DIRECTORY + '/line-graph'
 
 OUTPUT_FORMATS = ['png']
+DPI = 500
 COLOR_LEVELS = 60
 CORNER_SMOOTHING = False
 
-lons = [i+1.375 for i in range(TOTAL_LON)]
-lats = [i-1.375 for i in range(int(TOTAL_LAT/2), int(-TOTAL_LAT/2), -1)]
+# The figure of each variable drawn by this process, kept between days so only the line and date are redrawn
+frames = {}
 
 
-def save_file(dir, name):
-    """Save the current plot as an .svg in the image directory"""
+def save_file(figure, dir, name, dpi=DPI):
+    """
+    Save a figure in each output format in the image directory
+
+    returns:
+     - the paths written
+    """
 
     dir_path = f"{OUTPUT_DIRECTORY}/{dir}"
     try:
@@ -35,23 +51,176 @@ def save_file(dir, name):
         if e.errno != errno.EEXIST:
             raise
 
+    paths = []
     for output_format in OUTPUT_FORMATS:
         path = f"{dir_path}/{name}.{output_format}"
 
         if DEBUG:
             print(f"Writing {path}")
 
-        plt.savefig(path, format=output_format, bbox_inches='tight', dpi=500)
+        figure.savefig(path, format=output_format, bbox_inches='tight', dpi=dpi)
+        count_file(BYTES_WRITTEN, path)
+
+        paths.append(path)
+
+    return paths
+
+
+def nearest_column(lons, lon):
+    """Index of the grid longitude closest to lon, going around the globe if needed"""
+
+    return int(np.argmin(np.abs((np.asarray(lons) - lon + 180) % 360 - 180)))
+
+
+def lon_distance(a, b):
+    """Distance in degrees between longitudes, going around the globe if needed"""
+
+    return np.abs((np.asarray(a) - b + 180) % 360 - 180)
+
+
+def lon_str(lon):
+    """Longitude in degrees east or west, e.g. 185.375 -> 174.625 degrees W"""
+
+    lon = (float(lon) + 180) % 360 - 180
+
+    return f"{abs(lon):g}{DEG} {'W' if lon < 0 else 'E'}"
+
+
+def valid_counts(cube, variables):
+    """
+    Count the cells with data (not NaN, i.e. not land for sea surface temperature) in every column (longitude)
+    of each variable, summed over every day of a cube, a few days at a time
+
+    returns:
+     - dict of variable -> count per column
+    """
+
+    lon_counts = np.zeros((len(variables), cube.shape[3]), dtype=np.int64)
+
+    for start in range(0, len(cube), COUNT_CHUNK_DAYS):
+        with timer('read'):
+            valid = ~np.isnan(cube[start:start+COUNT_CHUNK_DAYS])
+            count(BYTES_READ, valid.size * cube.dtype.itemsize)
+
+        with timer('plot'):
+            lon_counts += valid.sum(axis=(0, 2))
+
+    return {var: lon_counts[i].tolist() for i, var in enumerate(variables)}
+
+
+def read_transects(input_dir, cube, variables):
+    """
+    The valid cell counts of a cube directory (see valid_counts), cached in its transects.json
+
+    The counts are only made again if the cube was rewritten since they were cached
+    """
+
+    cube_stat = stat(f"{input_dir}/{CUBE_FILENAME}")
+    cube_key = {'size': cube_stat.st_size, 'mtime': cube_stat.st_mtime_ns, 'variables': list(variables)}
+
+    try:
+        with open(f"{input_dir}/{TRANSECTS_FILENAME}", 'r') as my_file:
+            cached = json.load(my_file)
+        if cached['cube'] == cube_key:
+            return cached['lons']
+    except (FileNotFoundError, KeyError, ValueError):
+        pass
+
+    counts = valid_counts(cube, variables)
+
+    with open(f"{input_dir}/{TRANSECTS_FILENAME}", 'w') as outfile:
+        json.dump({'cube': cube_key, 'lons': counts}, outfile)
+
+    return counts
+
+
+def choose_transects(lons, counts, number=1, separation=TRANSECT_SEPARATION):
+    """
+    Choose the columns of the longitudes with the most data (the least land), at least separation degrees apart
+
+    Columns with the same count go to the one closest to LON first
+
+    returns:
+     - the chosen columns, most data first
+    """
+
+    lons = np.asarray(lons, dtype=np.float64)
+    order = np.lexsort((lon_distance(lons, LON), -np.asarray(counts)))
+
+    chosen = []
+    for column in order:
+        if len(chosen) == number:
+            break
+        if all(lon_distance(lons[column], lons[other]) >= separation for other in chosen):
+            chosen.append(int(column))
+
+    return chosen
+
+
+def uses_auto(value):
+    """Whether a comma separated list of transects (see parse_transects) has 'auto' in it"""
+
+    return 'auto' in [part.strip() for part in str(value).split(',')]
+
+
+def parse_transects(value, lons, counts, number=1):
+    """
+    Parse a comma separated list of longitudes and 'auto' into the columns to plot
+
+    'auto' is the number columns with the most data (see choose_transects), a longitude is its nearest column
+
+    returns:
+     - the columns, without repeats
+    """
+
+    columns = []
+    for part in str(value).split(','):
+        part = part.strip()
+        if part == 'auto':
+            columns.extend(choose_transects(lons, counts, number))
+        else:
+            columns.append(nearest_column(lons, float(part)))
 
+    return list(dict.fromkeys(columns))
+
+
+def get_frame(variable, grid, ranges=None, k=None, columns=None):
+    """
+    Get the figure for a variable, building its axes, labels and ticks the first time
 
-def plot(data, variable, day, output_dir=None, ranges=None, k=None):
-    """Plot a single variable on a single day"""
+    The figure is reused for every day of the variable, see draw_frame
+
+    parameters:
+     - variable : variable to plot
+     - grid : dict of the cell centre 'lats' and 'lons', see storage.read_grid
+     - ranges : (min, max) of the y axis, or None to scale each day to its own data
+     - k : k value shown on the plot
+     - columns : the grid columns (transects) to plot, one line each (the column nearest LON if None)
+
+    returns:
+     - dict of the figure and the artists that change from day to day
+    """
+
+    columns = tuple(columns) if columns else (nearest_column(grid['lons'], LON),)
+
+    key = (variable, tuple(ranges) if ranges else None, k, columns)
+    if key in frames:
+        return frames[key]
 
     title = get_english_variable_name(variable)
 
-    plt.suptitle(title, fontsize=16)
-    ax = plt.axes(label=f"{title}-{day}")
-    ax.plot(lats, data[:, LON], color='black')
+    figure = plt.figure()
+    figure.suptitle(title, fontsize=16)
+    ax = figure.add_subplot()
+
+    # A single transect is drawn in black as it always was, several get a colour each and a legend
+    lines = [
+        ax.plot(grid['lats'], np.full(len(grid['lats']), np.nan), label=lon_str(grid['lons'][column]),
+                **({'color': 'black'} if len(columns) == 1 else {}))[0]
+        for column in columns
+    ]
+    if len(columns) > 1:
+        ax.legend(fontsize=8, loc='lower center')
 
     ax.set_xlabel('Latitude')
 
@@ -59,60 +228,135 @@ def plot(data, variable, day, output_dir=None, ranges=None, k=None):
         ax.set_ylim(ranges)
     ax.set_ylabel(f"{get_english_variable_name(variable)} ({get_units(variable)})")
 
-    plt.xticks([90, 45, 0, -45, -90], [f'90{DEG} N', f'45{DEG} N', f'0{DEG}', f'45{DEG} S', f'90{DEG} S'])
+    ax.set_xticks([90, 45, 0, -45, -90], [f'90{DEG} N', f'45{DEG} N', f'0{DEG}', f'45{DEG} S', f'90{DEG} S'])
 
     if k:
         textstr = f"k={k}"
         ax.text(1, 1.05, textstr, transform=ax.transAxes, fontsize=9, horizontalalignment='right', verticalalignment='top')
 
-    textstr = day_str(day)
-    ax.text(0, 1.05, textstr, transform=ax.transAxes, fontsize=9, verticalalignment='top')
+    date = ax.text(0, 1.05, '', transform=ax.transAxes, fontsize=9, verticalalignment='top')
+
+    frames[key] = {
+        'figure': figure,
+        'ax': ax,
+        'columns': columns,
+        'ranges': ranges,
+        'lines': lines,
+        'date': date,
+    }
+
+    return frames[key]
+
+
+def draw_frame(frame, data, day):
+    """Draw a day's data on a figure from get_frame, replacing the lines and date of the previous day"""
+
+    for line, column in zip(frame['lines'], frame['columns']):
+        line.set_ydata(data[:, column])
+
+    if not frame['ranges']:
+        frame['ax'].relim()
+        frame['ax'].autoscale_view(scalex=False)
+
+    frame['date'].set_text(day_str(day))
+
+
+def close_frames():
+    """Release the figures kept by this process"""
+
+    for frame in frames.values():
+        plt.close(frame['figure'])
+
+    frames.clear()
+
 
-    file_dir = f"{output_dir}/{variable}" if output_dir else variable
-    save_file(file_dir, day)
+def generate_plots(path, indices=(0,), variable=None, output_dir=None, ranges=None, k=None, dpi=DPI, columns=None):
+    """
+    Generate the plots of a variable for a sequence of days given a day file (or a cube directory and day indices)
+
+    The figure is built once and reused for every day, then released. columns are the transects to plot, see get_frame
+
+    returns:
+     - the variable
+     - list of (day index, paths of the plots)
+     - the instrument stats
+    """
+
+    grid = read_grid(path)
+    outputs = []
+
+    for index in indices:
+        if DEBUG:
+            print('Generating plot for', path, index, variable)
 
+        with timer('read', index):
+            day, data = read_day(path, index)
+            values = np.array(data[variable], dtype=np.float64)
 
-def generate_plots(filename, output_dir=None, ranges=None, k=None):
-    """Generate plots for all variables given a .json file"""
+        with timer('plot', index):
+            frame = get_frame(variable, grid, ranges[variable] if ranges else None, k, columns)
+            draw_frame(frame, values, day)
 
-    if DEBUG:
-        print('Generating plot for', filename)
+        # Matplotlib only rasterizes the figure when saving it, so this includes the rendering time
+        with timer('write', index):
+            paths = save_file(frame['figure'], f"{output_dir}/{variable}" if output_dir else variable, day, dpi)
 
-    with open(filename, 'r') as my_file:
-        json_data = my_file.read()
-        data = json.loads(json_data)
+        outputs.append((index, paths))
 
-    day = basename(filename).split('.')[0]
+    close_frames()
 
-    for variable in data.keys():
-        plot(
-            np.array(data[variable], dtype=np.float64),
-            variable,
-            day,
-            output_dir=output_dir,
-            ranges=ranges[variable] if ranges else None,
-            k=k
-        )
+    return (variable, outputs, instrument.take())
 
 
-def find_lon_with_least_land(data):
+def generate_video(path, indices, variable, output_dir=None, ranges=None, k=None, fps=DEFAULT_FPS, dpi=DEFAULT_DPI, columns=None):
     """
-    Given a 2d array of data
-    return the index of the longitude with the least amount of land
+    Generate a video of a variable over a sequence of days given a cube directory and day indices
+
+    Each day is drawn on the same figure and its canvas is streamed into the video, see video.write_video.
+    columns are the transects to plot, see get_frame
+
+    returns:
+     - the variable
+     - list of (day index, [path of the video])
+     - the instrument stats
     """
-    nonzeros = np.empty(360)
-    for lon in range(360):
-        arr = np.array(data)
-        nonzeros[lon] = np.count_nonzero(arr[:, lon])
 
-    max_idx = np.where(nonzeros == np.amax(nonzeros))
+    grid = read_grid(path)
+
+    def render():
+        for index in indices:
+            with timer('read', index):
+                day, data = read_day(path, index)
+                values = np.array(data[variable], dtype=np.float64)
+
+            with timer('plot', index):
+                frame = get_frame(variable, grid, ranges[variable] if ranges else None, k, columns)
+                frame['figure'].set_dpi(dpi)
+                draw_frame(frame, values, day)
+
+            # Rendering the canvas and encoding the frame
+            with timer('write', index):
+                yield capture(frame['figure'])
+
+    dir_path = f"{OUTPUT_DIRECTORY}/{output_dir}" if output_dir else OUTPUT_DIRECTORY
+    video = write_video(f"{dir_path}/{variable}", render(), fps)
 
-    return max_idx[0]
+    close_frames()
 
+    return (variable, [(index, [video]) for index in indices], instrument.take())
 
-def init():
+
+def generate_plots_task(task):
+    return generate_plots(*task)
+
+
+def generate_video_task(task):
+    return generate_video(*task)
+
+
+def init(output_dir=None):
     try:
-        makedirs(OUTPUT_DIRECTORY)
+        makedirs(f"{OUTPUT_DIRECTORY}/{output_dir}" if output_dir else OUTPUT_DIRECTORY)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
@@ -120,16 +364,43 @@ def init():
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", help="Input JSON file")
+    parser.add_argument("-i", "--input", help="Input day file or cube directory")
     parser.add_argument("-o", "--output", help="Output subdirectory", default=None)
     parser.add_argument('-k', '--k', help='k value', default=DEFAULT_K)
+    parser.add_argument("-f", "--force", action='store_true', help="Plot every day, even if it hasn't changed since the last run")
+    parser.add_argument("-P", "--profile", help="Comma separated stages to profile with cProfile (read, plot, write), or 'all'")
+    parser.add_argument("-d", "--days", help="Days to plot: day numbers/ranges, 'first-of-month' or 'every:<n>' (every day if not set)")
+    parser.add_argument("--video", action='store_true', help="Stream the days of each variable into one video instead of a png per day")
+    parser.add_argument("--fps", type=int, help="Frames per second of the videos", default=DEFAULT_FPS)
+    parser.add_argument("-l", "--lon", help="Comma separated longitudes of the transects, or 'auto' for the ones with the least land",
+                        default=str(LON))
+    parser.add_argument("-t", "--transects", type=int, help="Number of transects chosen by 'auto'", default=1)
+    parser.add_argument("--dpi", type=int, help=f"Resolution of the figures (default {DPI}, or {DEFAULT_DPI} for videos)")
     args = parser.parse_args()
 
-    init()
+    dpi = args.dpi or (DEFAULT_DPI if args.video else DPI)
+
+    start = time.perf_counter()
+
+    init(args.output)
 
     # If input is a single file, easy case
     if args.input and isfile(args.input):
-        generate_plots(args.input, args.output, k=args.k)
+        if args.video:
+            parser.error('--video needs a cube directory')
+
+        if args.profile:
+            instrument.enable_profiling(args.profile, dirname(args.input) or '.')
+
+        variables = read_metadata(dirname(args.input) or '.')['variables']
+        _, data = read_day(args.input)
+        counts = valid_counts(np.stack([data[var] for var in variables])[np.newaxis], variables) if uses_auto(args.lon) else None
+        lons = read_grid(args.input)['lons']
+
+        for variable in variables:
+            columns = parse_transects(args.lon, lons, counts[variable] if counts else None, args.transects)
+            instrument.merge(generate_plots(args.input, [0], variable, args.output, k=args.k, dpi=dpi, columns=columns)[2])
+        instrument.write_report(dirname(args.input) or '.', 'generate_line_graph', time.perf_counter() - start)
         exit()
 
     # Since input isn't a single file, it's either
@@ -137,10 +408,10 @@ if __name__ == '__main__':
     #   b) not specified
     input_dir = args.input if args.input and isdir(args.input) else INPUT_DIRECTORY
 
-    print("Generating plots for all .json files in", input_dir)
+    print("Generating plots for all days in", input_dir)
 
-    # Collect all the .json files in input_dir
-    files = [f"{input_dir}/{f}" for f in listdir(input_dir) if isfile(join(input_dir, f)) if f.endswith('json') if not f.startswith('range')]
+    if args.profile:
+        instrument.enable_profiling(args.profile, input_dir)
 
     try:
         with open(f"{input_dir}/range.json", 'r') as my_file:
@@ -149,5 +420,79 @@ if __name__ == '__main__':
     except FileNotFoundError:
         ranges = None
 
-    pool = mp.Pool(mp.cpu_count())
-    pool.starmap(generate_plots, [(file, args.output, ranges, args.k) for file in files])
+    # Only plot the days whose data changed since the last run (or that were never plotted)
+    cube, metadata = open_cube(input_dir)
+    days = metadata['days']
+
+    try:
+        selected = select_days(days, args.days)
+    except ValueError as e:
+        parser.error(f"Invalid --days: {e}")
+
+    input_hashes = {index: hash_arrays(cube[index]) for index in selected}
+
+    # The transects of each variable are chosen once for the run, from counts cached with the cube
+    variables = metadata['variables']
+    lons = read_grid(input_dir)['lons']
+    counts = read_transects(input_dir, cube, variables) if uses_auto(args.lon) else None
+    transects = {
+        var: parse_transects(args.lon, lons, counts[var] if counts else None, args.transects)
+        for var in variables
+    }
+
+    manifest = read_manifest(
+        f"{OUTPUT_DIRECTORY}/{args.output}" if args.output else OUTPUT_DIRECTORY,
+        {
+            'ranges': ranges,
+            'k': args.k,
+            'formats': OUTPUT_FORMATS,
+            'dpi': dpi,
+            'video': {'fps': args.fps, 'days': args.days} if args.video else None,
+            'transects': {var: [lons[column] for column in columns] for var, columns in transects.items()},
+        },
+    )
+    stale = [index for index in selected if args.force or not is_fresh(manifest, days[index], input_hashes[index])]
+
+    # A video is made of every selected day, so it is redone as a whole if any of them changed
+    if args.video and stale:
+        stale = selected
+
+    print(f"Plotting {len(stale)} of {len(selected)} days")
+    processes = mp.cpu_count()
+
+    if args.video:
+        # Each task streams every day of a single variable into its video
+        function = generate_video_task
+        tasks = [
+            (input_dir, stale, variable, args.output, ranges, args.k, args.fps, dpi, transects[variable])
+            for variable in variables
+        ] if stale else []
+    else:
+        # Each task plots a run of days of a single variable, so its figure is only built once
+        function = generate_plots_task
+        chunk = max(1, -(-len(stale) * len(variables) // (processes * TASKS_PER_WORKER)))
+        tasks = [
+            (input_dir, stale[start:start+chunk], variable, args.output, ranges, args.k, dpi, transects[variable])
+            for variable in variables for start in range(0, len(stale), chunk)
+        ]
+
+    outputs = {index: [] for index in stale}
+    remaining = {index: len(variables) for index in stale}
+
+    with mp.Pool(processes) as pool:
+        for (variable, task_outputs, task_stats) in pool.imap_unordered(function, tasks):
+            instrument.merge(task_stats)
+
+            # A day is done once every variable has been plotted
+            for (index, paths) in task_outputs:
+                outputs[index] += paths
+                remaining[index] -= 1
+
+                if remaining[index] == 0:
+                    record_day(manifest, days[index], input_hashes[index], outputs[index])
+                    write_manifest(manifest, force=False)
+
+    write_manifest(manifest)
+
+    # The report goes next to the range.json of the plotted data
+    instrument.write_report(input_dir, 'generate_line_graph', time.perf_counter() - start)
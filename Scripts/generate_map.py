@@ -1,8 +1,9 @@
-from os import listdir, makedirs
-from os.path import isfile, isdir, join, basename
+from os import makedirs
+from os.path import isfile, isdir, dirname
 import errno
 import json
 import argparse
+import time
 import numpy as np
 import multiprocessing as mp
 import matplotlib.pyplot as plt
@@ -10,8 +11,15 @@ import matplotlib.ticker as mticker
 from matplotlib import colors, cm
 import cartopy.crs as ccrs
 
-from consts import TOTAL_LAT, TOTAL_LON, CONVERTED_DIRECTORY, VISUALS_DIRECTORY, DEFAULT_K
-from utils import get_units, get_english_variable_name, day_str
+from consts import CONVERTED_DIRECTORY, VISUALS_DIRECTORY, DEFAULT_K
+from utils import get_units, get_english_variable_name, day_str, select_days
+from storage import read_day, read_grid, read_metadata, open_cube
+from manifest import hash_arrays, read_manifest, write_manifest, is_fresh, record_day
+import instrument
+from instrument import timer, count_file, BYTES_WRITTEN
+from workers import TASKS_PER_WORKER
+from video import capture, write_video, DEFAULT_FPS, DEFAULT_DPI
+from raster import discrete_levels, discrete_colormap, palette_indices, palette_rgba, write_indexed_png
 
 DEBUG = False
 
@@ -19,15 +27,22 @@ INPUT_DIRECTORY = CONVERTED_DIRECTORY
 OUTPUT_DIRECTORY = VISUALS_DIRECTORY + '/map'
 
 OUTPUT_FORMATS = ['png']
+DPI = 500
 COLOR_LEVELS = 60
 CORNER_SMOOTHING = True
 
-lons = [i+1.375 for i in range(TOTAL_LON)]
-lats = [i-1.375 for i in range(int(TOTAL_LAT/2), int(-TOTAL_LAT/2), -1)]
+# contour : filled contours (publication figures)
+# raster : one block of colour per cell, with a colour per cluster mean (fast previews)
+# palette : an indexed png of the grid alone, written straight from numpy without a figure (fastest)
+RENDERERS = ['contour', 'raster', 'palette']
+DEFAULT_RENDERER = 'contour'
 
+# The figure of each variable drawn by this process, kept between days so only the contours and date are redrawn
+frames = {}
 
-def save_file(dir, name):
-    """Save the current plot as an .svg in the image directory"""
+
+def image_directory(dir):
+    """Create (if needed) and return the path of a directory in the image directory"""
 
     dir_path = f"{OUTPUT_DIRECTORY}/{dir}"
     try:
@@ -36,13 +51,32 @@ def save_file(dir, name):
         if e.errno != errno.EEXIST:
             raise
 
+    return dir_path
+
+
+def save_file(figure, dir, name, dpi=DPI):
+    """
+    Save a figure in each output format in the image directory
+
+    returns:
+     - the paths written
+    """
+
+    dir_path = image_directory(dir)
+
+    paths = []
     for output_format in OUTPUT_FORMATS:
         path = f"{dir_path}/{name}.{output_format}"
 
         if DEBUG:
             print(f"Writing {path}")
 
-        plt.savefig(path, format=output_format, bbox_inches='tight', dpi=500)
+        figure.savefig(path, format=output_format, bbox_inches='tight', dpi=dpi)
+        count_file(BYTES_WRITTEN, path)
+
+        paths.append(path)
+
+    return paths
 
 
 def color_map(var):
@@ -52,25 +86,76 @@ def color_map(var):
         return cm.jet
 
 
-def plot(data, variable, day, cmap, output_dir=None, ranges=None, k=None):
-    """Plot a single variable on a single day"""
+def is_global(grid):
+    """Whether the cells of a grid cover the whole globe"""
+
+    lat_span = abs(grid['lats'][0] - grid['lats'][-1]) * len(grid['lats']) / max(len(grid['lats']) - 1, 1)
+    lon_span = abs(grid['lons'][-1] - grid['lons'][0]) * len(grid['lons']) / max(len(grid['lons']) - 1, 1)
+
+    return lat_span >= 180 and lon_span >= 360
+
+
+def map_columns(lons):
+    """
+    Order of the grid columns that puts their longitudes between -180 and 180, and those longitudes
+
+    Cartopy can draw contours in that range without reprojecting them, which is most of the time spent plotting.
+    Grids that would be split in two by the 180 meridian are left as they are.
+
+    returns:
+     - column order
+     - longitude of each column in that order
+    """
+
+    lons = np.asarray(lons, dtype=np.float64)
+    wrapped = (lons + 180) % 360 - 180
+    order = np.argsort(wrapped, kind='stable')
+
+    steps = np.diff(wrapped[order])
+    if len(steps) == 0 or np.allclose(steps, steps[0]):
+        return (order, wrapped[order])
+
+    return (np.arange(len(lons)), lons)
+
+
+def cell_extent(lats, lons):
+    """Extent [west, east, south, north] of the edges of the grid cells, with the cell centres at lats and lons"""
+
+    lat_step = abs(lats[1] - lats[0]) if len(lats) > 1 else 1
+    lon_step = abs(lons[1] - lons[0]) if len(lons) > 1 else 1
+
+    return [lons[0] - lon_step / 2, lons[-1] + lon_step / 2, np.min(lats) - lat_step / 2, np.max(lats) + lat_step / 2]
+
+
+def get_frame(variable, grid, ranges=None, k=None, renderer=DEFAULT_RENDERER):
+    """
+    Get the figure for a variable, building its axes, coastlines, equator line and colorbar the first time
+
+    The figure is reused for every day of the variable, see draw_frame
+
+    parameters:
+     - variable : variable to plot
+     - grid : dict of the cell centre 'lats' and 'lons', see storage.read_grid
+     - ranges : (min, max) of the colour scale, or None to scale each day to its own data
+     - k : k value shown on the plot
+     - renderer : how the data is drawn, 'contour' or 'raster'
+
+    returns:
+     - dict of the figure and the artists that change from day to day
+    """
+
+    key = (variable, tuple(ranges) if ranges else None, k, renderer)
+    if key in frames:
+        return frames[key]
 
     title = get_english_variable_name(variable)
+    units = get_units(variable)
+    cmap = color_map(variable)
     min, max = ranges or (None, None)
 
-    ax = plt.axes(projection=ccrs.PlateCarree(), label=f"{title}-{day}")
+    figure = plt.figure()
+    ax = figure.add_subplot(projection=ccrs.PlateCarree())
     ax.set_title(title, fontsize=16)
-    plt.contourf(
-        lons,
-        lats,
-        data,
-        COLOR_LEVELS,
-        transform=ccrs.PlateCarree(),
-        vmin=min,
-        vmax=max,
-        cmap=cmap,
-        corner_mask=CORNER_SMOOTHING,
-    )
 
     # Draw a line on the equator
     gl = ax.gridlines(crs=ccrs.PlateCarree(), linewidth=0.5, color='black', alpha=1, linestyle='-')
@@ -81,53 +166,256 @@ def plot(data, variable, day, cmap, output_dir=None, ranges=None, k=None):
         textstr = f"k={k}"
         ax.text(1, -0.05, textstr, transform=ax.transAxes, fontsize=9, horizontalalignment='right', verticalalignment='top')
 
-    textstr = day_str(day)
-    ax.text(0, -0.05, textstr, transform=ax.transAxes, fontsize=9, verticalalignment='top')
+    date = ax.text(0, -0.05, '', transform=ax.transAxes, fontsize=9, verticalalignment='top')
+
+    # Only show the region that was converted
+    if is_global(grid):
+        ax.set_global()
+    else:
+        ax.set_extent([grid['lons'][0], grid['lons'][-1], grid['lats'][-1], grid['lats'][0]], crs=ccrs.PlateCarree())
 
     ax.coastlines()
 
-    if ranges:
-        norm = colors.Normalize(vmin=min, vmax=max)
-    else:
-        norm = colors.Normalize(vmin=np.nanmin(data), vmax=np.nanmax(data))
+    # Without ranges, the colour scale is set to each day's data in draw_frame
+    sm = plt.cm.ScalarMappable(cmap=cmap, norm=colors.Normalize(vmin=min, vmax=max))
+    cb = figure.colorbar(sm, ax=ax, shrink=0.5, orientation='vertical', pad=0.025)
+    cb.formatter = mticker.FuncFormatter(lambda val, _: f"{val:g} {units}")
+
+    (columns, lons) = map_columns(grid['lons'])
+
+    frames[key] = {
+        'figure': figure,
+        'ax': ax,
+        'renderer': renderer,
+        'lats': grid['lats'],
+        'lons': lons,
+        'columns': columns,
+        'extent': cell_extent(grid['lats'], lons),
+        'origin': 'upper' if grid['lats'][0] > grid['lats'][-1] else 'lower',
+        'cmap': cmap,
+        'ranges': ranges,
+        'scale': sm,
+        'colorbar': cb,
+        'date': date,
+        'layer': None,
+    }
+
+    return frames[key]
+
+
+def draw_raster(frame, data):
+    """
+    Draw a grid on a figure from get_frame as one block of colour per cell
+
+    Clustered data is drawn with one colour per cluster mean, the colour of the colorbar at that mean
+    """
+
+    cmap = frame['cmap']
+    norm = frame['scale'].norm
+
+    levels = discrete_levels(data)
+    if levels is not None:
+        (cmap, norm) = discrete_colormap(levels, cmap, norm)
+
+    return frame['ax'].imshow(
+        data,
+        extent=frame['extent'],
+        origin=frame['origin'],
+        transform=ccrs.PlateCarree(),
+        cmap=cmap,
+        norm=norm,
+        interpolation='nearest',
+    )
+
+
+def draw_frame(frame, data, day):
+    """Draw a day's data on a figure from get_frame, replacing the contours (or raster) and date of the previous day"""
+
+    if frame['layer'] is not None:
+        frame['layer'].remove()
+
+    min, max = frame['ranges'] or (None, None)
+
+    if not frame['ranges']:
+        frame['scale'].set_clim(np.nanmin(data), np.nanmax(data))
+        frame['colorbar'].update_ticks()
+
+    frame['date'].set_text(day_str(day))
+
+    if frame['renderer'] == 'raster':
+        frame['layer'] = draw_raster(frame, data[:, frame['columns']])
+        return
+
+    frame['layer'] = frame['ax'].contourf(
+        frame['lons'],
+        frame['lats'],
+        data[:, frame['columns']],
+        COLOR_LEVELS,
+        transform=ccrs.PlateCarree(),
+        vmin=min,
+        vmax=max,
+        cmap=frame['cmap'],
+        corner_mask=CORNER_SMOOTHING,
+    )
+
+
+def palette_frame(variable, grid, data, ranges=None):
+    """
+    Map a day's data to palette indices for the palette renderer, the same way up as the maps
+    (north at the top, and longitudes from -180 to 180 for global grids)
+
+    returns:
+     - uint8 array of palette indices, index 0 is NaN (see raster.palette_indices)
+     - the palette
+    """
 
-    sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-    cb = plt.colorbar(sm, shrink=0.5, orientation='vertical', pad=0.025)
-    ticks = cb.get_ticks()
-    cb.set_ticks(ticks)
-    cb.set_ticklabels([f"{val} {get_units(variable)}" for val in ticks])
+    (columns, _) = map_columns(grid['lons'])
+    data = data[:, columns]
+    if grid['lats'][0] < grid['lats'][-1]:
+        data = data[::-1]
 
-    file_dir = f"{output_dir}/{variable}" if output_dir else variable
-    save_file(file_dir, day)
+    min, max = ranges or (np.nanmin(data), np.nanmax(data))
 
+    return palette_indices(data, color_map(variable), colors.Normalize(vmin=min, vmax=max))
 
-def generate_plots(filename, output_dir=None, ranges=None, k=None):
-    """Generate plots for all variables given a .json file"""
+
+def save_palette(indices, palette, dir, name, scale=1):
+    """
+    Save palette indices as an indexed png in the image directory, scaled up by an integer factor
+
+    returns:
+     - the paths written
+    """
+
+    path = f"{image_directory(dir)}/{name}.png"
 
     if DEBUG:
-        print('Generating plot for', filename)
+        print(f"Writing {path}")
+
+    write_indexed_png(path, indices, palette, scale)
+
+    return [path]
+
+
+def close_frames():
+    """Release the figures kept by this process"""
+
+    for frame in frames.values():
+        plt.close(frame['figure'])
+
+    frames.clear()
+
+
+def generate_plots(path, indices=(0,), variable=None, output_dir=None, ranges=None, k=None, dpi=DPI,
+                   renderer=DEFAULT_RENDERER, scale=1):
+    """
+    Generate the plots of a variable for a sequence of days given a day file (or a cube directory and day indices)
+
+    The figure is built once and reused for every day, then released. The palette renderer writes the grid
+    as an indexed png scaled up by scale, without a figure
+
+    returns:
+     - the variable
+     - list of (day index, paths of the plots)
+     - the instrument stats
+    """
+
+    grid = read_grid(path)
+    outputs = []
+
+    for index in indices:
+        if DEBUG:
+            print('Generating plot for', path, index, variable)
+
+        with timer('read', index):
+            day, data = read_day(path, index)
+            values = np.array(data[variable], dtype=np.float64)
+
+        dir = f"{output_dir}/{variable}" if output_dir else variable
+
+        if renderer == 'palette':
+            with timer('plot', index):
+                (image, palette) = palette_frame(variable, grid, values, ranges[variable] if ranges else None)
+
+            with timer('write', index):
+                paths = save_palette(image, palette, dir, day, scale)
+
+            outputs.append((index, paths))
+            continue
+
+        with timer('plot', index):
+            frame = get_frame(variable, grid, ranges[variable] if ranges else None, k, renderer)
+            draw_frame(frame, values, day)
 
-    with open(filename, 'r') as my_file:
-        json_data = my_file.read()
-        data = json.loads(json_data)
+        # Matplotlib only rasterizes the figure when saving it, so this includes the rendering time
+        with timer('write', index):
+            paths = save_file(frame['figure'], dir, day, dpi)
 
-    day = basename(filename).split('.')[0]
+        outputs.append((index, paths))
 
-    for variable in data.keys():
-        plot(
-            np.array(data[variable], dtype=np.float64),
-            variable,
-            day,
-            color_map(variable),
-            output_dir=output_dir,
-            ranges=ranges[variable] if ranges else None,
-            k=k,
-        )
+    close_frames()
 
+    return (variable, outputs, instrument.take())
 
-def init():
+
+def generate_video(path, indices, variable, output_dir=None, ranges=None, k=None, fps=DEFAULT_FPS, dpi=DEFAULT_DPI,
+                   renderer=DEFAULT_RENDERER, scale=1):
+    """
+    Generate a video of a variable over a sequence of days given a cube directory and day indices
+
+    Each day is drawn on the same figure and its canvas is streamed into the video, see video.write_video.
+    The palette renderer streams the grid itself, scaled up by scale
+
+    returns:
+     - the variable
+     - list of (day index, [path of the video])
+     - the instrument stats
+    """
+
+    grid = read_grid(path)
+
+    def render():
+        for index in indices:
+            with timer('read', index):
+                day, data = read_day(path, index)
+                values = np.array(data[variable], dtype=np.float64)
+
+            if renderer == 'palette':
+                with timer('plot', index):
+                    (image, palette) = palette_frame(variable, grid, values, ranges[variable] if ranges else None)
+
+                with timer('write', index):
+                    yield palette_rgba(image, palette, scale)
+                continue
+
+            with timer('plot', index):
+                frame = get_frame(variable, grid, ranges[variable] if ranges else None, k, renderer)
+                frame['figure'].set_dpi(dpi)
+                draw_frame(frame, values, day)
+
+            # Rendering the canvas and encoding the frame
+            with timer('write', index):
+                yield capture(frame['figure'])
+
+    dir_path = f"{OUTPUT_DIRECTORY}/{output_dir}" if output_dir else OUTPUT_DIRECTORY
+    video = write_video(f"{dir_path}/{variable}", render(), fps)
+
+    close_frames()
+
+    return (variable, [(index, [video]) for index in indices], instrument.take())
+
+
+def generate_plots_task(task):
+    return generate_plots(*task)
+
+
+def generate_video_task(task):
+    return generate_video(*task)
+
+
+def init(output_dir=None):
     try:
-        makedirs(OUTPUT_DIRECTORY)
+        makedirs(f"{OUTPUT_DIRECTORY}/{output_dir}" if output_dir else OUTPUT_DIRECTORY)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
@@ -135,16 +423,36 @@ def init():
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", help="Input JSON file")
+    parser.add_argument("-i", "--input", help="Input day file or cube directory")
     parser.add_argument("-o", "--output", help="Output subdirectory", default=None)
     parser.add_argument('-k', '--k', help='k value', default=DEFAULT_K)
+    parser.add_argument("-f", "--force", action='store_true', help="Plot every day, even if it hasn't changed since the last run")
+    parser.add_argument("-P", "--profile", help="Comma separated stages to profile with cProfile (read, plot, write), or 'all'")
+    parser.add_argument("-d", "--days", help="Days to plot: day numbers/ranges, 'first-of-month' or 'every:<n>' (every day if not set)")
+    parser.add_argument("--video", action='store_true', help="Stream the days of each variable into one video instead of a png per day")
+    parser.add_argument("--fps", type=int, help="Frames per second of the videos", default=DEFAULT_FPS)
+    parser.add_argument("--dpi", type=int, help=f"Resolution of the figures (default {DPI}, or {DEFAULT_DPI} for videos)")
+    parser.add_argument("--renderer", choices=RENDERERS, help="How the maps are drawn", default=DEFAULT_RENDERER)
+    parser.add_argument("--scale", type=int, help="Pixels per grid cell of the palette renderer", default=1)
     args = parser.parse_args()
 
-    init()
+    dpi = args.dpi or (DEFAULT_DPI if args.video else DPI)
+
+    start = time.perf_counter()
+
+    init(args.output)
 
     # If input is a single file, easy case
     if args.input and isfile(args.input):
-        generate_plots(args.input, args.output, k=args.k)
+        if args.video:
+            parser.error('--video needs a cube directory')
+
+        if args.profile:
+            instrument.enable_profiling(args.profile, dirname(args.input) or '.')
+
+        for variable in read_metadata(dirname(args.input) or '.')['variables']:
+            instrument.merge(generate_plots(args.input, [0], variable, args.output, k=args.k, dpi=dpi, renderer=args.renderer, scale=args.scale)[2])
+        instrument.write_report(dirname(args.input) or '.', 'generate_map', time.perf_counter() - start)
         exit()
 
     # Since input isn't a single file, it's either
@@ -152,10 +460,10 @@ if __name__ == '__main__':
     #   b) not specified
     input_dir = args.input if args.input and isdir(args.input) else INPUT_DIRECTORY
 
-    print("Generating plots for all .json files in", input_dir)
+    print("Generating plots for all days in", input_dir)
 
-    # Collect all the .json files in input_dir
-    files = [f"{input_dir}/{f}" for f in listdir(input_dir) if isfile(join(input_dir, f)) if f.endswith('json') if not f.startswith('range')]
+    if args.profile:
+        instrument.enable_profiling(args.profile, input_dir)
 
     try:
         with open(f"{input_dir}/range.json", 'r') as my_file:
@@ -164,5 +472,73 @@ if __name__ == '__main__':
     except FileNotFoundError:
         ranges = None
 
-    pool = mp.Pool(mp.cpu_count())
-    pool.starmap(generate_plots, [(file, args.output, ranges, args.k) for file in files])
+    # Only plot the days whose data changed since the last run (or that were never plotted)
+    cube, metadata = open_cube(input_dir)
+    days = metadata['days']
+
+    try:
+        selected = select_days(days, args.days)
+    except ValueError as e:
+        parser.error(f"Invalid --days: {e}")
+
+    input_hashes = {index: hash_arrays(cube[index]) for index in selected}
+
+    manifest = read_manifest(
+        f"{OUTPUT_DIRECTORY}/{args.output}" if args.output else OUTPUT_DIRECTORY,
+        {
+            'ranges': ranges,
+            'k': args.k,
+            'formats': OUTPUT_FORMATS,
+            'dpi': dpi,
+            'renderer': args.renderer,
+            'scale': args.scale if args.renderer == 'palette' else None,
+            'video': {'fps': args.fps, 'days': args.days} if args.video else None,
+        },
+    )
+    stale = [index for index in selected if args.force or not is_fresh(manifest, days[index], input_hashes[index])]
+
+    # A video is made of every selected day, so it is redone as a whole if any of them changed
+    if args.video and stale:
+        stale = selected
+
+    print(f"Plotting {len(stale)} of {len(selected)} days")
+
+    variables = metadata['variables']
+    processes = mp.cpu_count()
+
+    if args.video:
+        # Each task streams every day of a single variable into its video
+        function = generate_video_task
+        tasks = [
+            (input_dir, stale, variable, args.output, ranges, args.k, args.fps, dpi, args.renderer, args.scale)
+            for variable in variables
+        ] if stale else []
+    else:
+        # Each task plots a run of days of a single variable, so its figure is only built once
+        function = generate_plots_task
+        chunk = max(1, -(-len(stale) * len(variables) // (processes * TASKS_PER_WORKER)))
+        tasks = [
+            (input_dir, stale[start:start+chunk], variable, args.output, ranges, args.k, dpi, args.renderer, args.scale)
+            for variable in variables for start in range(0, len(stale), chunk)
+        ]
+
+    outputs = {index: [] for index in stale}
+    remaining = {index: len(variables) for index in stale}
+
+    with mp.Pool(processes) as pool:
+        for (variable, task_outputs, task_stats) in pool.imap_unordered(function, tasks):
+            instrument.merge(task_stats)
+
+            # A day is done once every variable has been plotted
+            for (index, paths) in task_outputs:
+                outputs[index] += paths
+                remaining[index] -= 1
+
+                if remaining[index] == 0:
+                    record_day(manifest, days[index], input_hashes[index], outputs[index])
+                    write_manifest(manifest, force=False)
+
+    write_manifest(manifest)
+
+    # The report goes next to the range.json of the plotted data
+    instrument.write_report(input_dir, 'generate_map', time.perf_counter() - start)
@@ -1,87 +1,124 @@
 from os import makedirs
+from os.path import basename, isfile, splitext
+from glob import glob
+import argparse
 import errno
 import pandas as pd
 import matplotlib.pyplot as plt
 
-from consts import DATA_DIRECTORY, VISUALS_DIRECTORY
+from consts import PERFORMANCE_DIRECTORY, VISUALS_DIRECTORY
+from benchmark import METRICS
 
 FILENAMES = ['operations.csv', 'operations_ratio.csv']
 IMG_DIRECTORY = f"{VISUALS_DIRECTORY}/performance"
 OUTPUT_FORMATS = ['png']
 
-INPUT_DIRECTORY = f"{DATA_DIRECTORY}/performance"
+INPUT_DIRECTORY = PERFORMANCE_DIRECTORY
 
 
-def save_file(name):
-    """Save the current plot as an .svg in the image directory"""
+def save_file(name, img_dir=IMG_DIRECTORY):
+    """Save the current plot in each output format in the image directory"""
 
-    dir_path = f"{IMG_DIRECTORY}"
     try:
-        makedirs(dir_path)
+        makedirs(img_dir)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
 
     for output_format in OUTPUT_FORMATS:
-        path = f"{IMG_DIRECTORY}/{name}.{output_format}"
+        path = f"{img_dir}/{name}.{output_format}"
 
         print(f"Writing {path}")
 
         plt.savefig(path, format=output_format, bbox_inches='tight', dpi=500)
 
 
-def operations():
-    title = 'Number of operations'
-    input_file = f'{INPUT_DIRECTORY}/operations.csv'
-    output_file = 'operations'
+def plot_csv(input_file, title, ylabel, output_file, img_dir=IMG_DIRECTORY, reference=False, log=False):
+    """
+    Plot every column of a performance .csv against its first column
+
+    parameters:
+     - input_file : .csv with the x values in the first column and a series in every other column
+     - title : title of the figure
+     - ylabel : label of the y axis (the x axis is labelled with the name of the first column)
+     - output_file : name of the output image, without extension
+     - reference : also plot the first column against itself as a dashed grey reference line
+     - log : use a log scale on the y axis
+    """
 
     data = pd.read_csv(input_file, sep=',', header=0)
 
-    plt.suptitle(title, fontsize=16)
+    fig = plt.figure()
+    fig.suptitle(title, fontsize=16)
 
     ax = plt.axes(label=title)
-    ax.set_xlabel('Dataset size')
-    ax.set_ylabel('Number of operations')
-    ax.ticklabel_format(useMathText=True, useOffset=False)
+    ax.set_xlabel(data.columns[0])
+    ax.set_ylabel(ylabel)
+    if log:
+        ax.set_yscale('log')
+    else:
+        ax.ticklabel_format(useMathText=True, useOffset=False)
 
-    dataset_size = data.get(data.columns[0])
+    x = data.get(data.columns[0])
 
     for col in data.columns:
         if col == data.columns[0]:
-            ax.plot(dataset_size, data.get(col), label=col, color='grey', alpha=0.5, linestyle='--')
+            if reference:
+                ax.plot(x, data.get(col), label=col, color='grey', alpha=0.5, linestyle='--')
         else:
-            ax.plot(dataset_size, data.get(col), label=col)
+            ax.plot(x, data.get(col), label=col, marker='.')
 
     ax.legend()
 
-    save_file(output_file)
+    save_file(output_file, img_dir)
+    plt.close(fig)
 
 
-def operations_ratio():
-    title = 'Ratio of operations over dataset size'
-    input_file = f'{INPUT_DIRECTORY}/operations_ratio.csv'
-    output_file = 'operations_ratio'
+def operations():
+    plot_csv(
+        f'{INPUT_DIRECTORY}/operations.csv',
+        'Number of operations',
+        'Number of operations',
+        'operations',
+        reference=True,
+    )
 
-    data = pd.read_csv(input_file, sep=',', header=0)
 
-    plt.suptitle(title, fontsize=16)
+def operations_ratio():
+    plot_csv(
+        f'{INPUT_DIRECTORY}/operations_ratio.csv',
+        'Ratio of operations over dataset size',
+        'Number of operations / dataset size',
+        'operations_ratio',
+    )
 
-    ax = plt.axes(label=title)
-    ax.set_xlabel('Dataset size')
-    ax.set_ylabel('Number of operations / dataset size')
-    ax.ticklabel_format(useMathText=True)
 
-    dataset_size = data.get(data.columns[0])
+def benchmark(input_dir, img_dir):
+    """
+    Plot every {metric}_{distribution}_{n or k}={value}.csv written by benchmark.py in input_dir
+    """
 
-    for col in data.columns:
-        if col != data.columns[0]:
-            ax.plot(dataset_size, data.get(col), label=col)
+    for input_file in sorted(glob(f"{input_dir}/*.csv")):
+        name = splitext(basename(input_file))[0]
+        metric = next((metric for metric in METRICS if name.startswith(f"{metric}_")), None)
+        if metric is None:
+            continue
 
-    ax.legend()
+        (distribution, fixed) = name[len(metric) + 1:].split('_', 1)
+        title = f"{METRICS[metric].split(' (')[0]}, {distribution} distribution, {fixed}"
 
-    save_file(output_file)
+        plot_csv(input_file, title, METRICS[metric], name, img_dir, log=metric in ['wall_time', 'operations'])
 
 
 if __name__ == '__main__':
-    operations()
-    operations_ratio()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', help='Benchmark subdirectory of Data/performance (see benchmark.py)')
+    args = parser.parse_args()
+
+    if args.input:
+        benchmark(f"{INPUT_DIRECTORY}/{args.input}", f"{IMG_DIRECTORY}/{args.input}")
+    else:
+        if isfile(f'{INPUT_DIRECTORY}/operations.csv'):
+            operations()
+        if isfile(f'{INPUT_DIRECTORY}/operations_ratio.csv'):
+            operations_ratio()
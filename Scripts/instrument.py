@@ -0,0 +1,251 @@
+from os import getpid, makedirs, remove
+from os.path import getsize
+from contextlib import contextmanager
+from glob import glob
+import cProfile
+import errno
+import json
+import pstats
+import time
+
+"""
+file: instrument
+
+purpose:
+ - time the stages of every script (read, compute, write...) and count what they processed
+ - stats are kept per process: pool workers hand theirs back with take(), and the parent merges them with merge()
+ - a run report is written as <name>_report.json (totals, per stage and per day) and <name>_report.csv (per day)
+ - counters can also be counted under a group (e.g. each k of a sweep), which gets a report of its own
+ - optionally profile chosen stages with cProfile, merged across workers into profile/<stage>.prof
+"""
+
+REPORT_SUFFIX = 'report'
+PROFILE_DIRECTORY = 'profile'
+PROFILE_LINES = 30          # number of functions in the text summary of each profile
+
+# Counters
+BYTES_READ = 'bytes_read'
+BYTES_WRITTEN = 'bytes_written'
+CELLS = 'cells'
+ITERATIONS = 'iterations'
+DISTANCES = 'distances'
+TIES = 'ties'
+
+stats = {'timers': {}, 'counters': {}, 'days': {}, 'groups': {}}
+group = None
+
+profile_stages = set()
+profile_dir = None
+profiles = {}
+
+
+@contextmanager
+def timer(stage, day=None):
+    """
+    Time the body of a with block as part of a stage, and of a day if given
+
+    e.g.
+        with timer('read', day):
+            data = read_day(path, index)
+    """
+
+    profile = None
+    if stage in profile_stages or 'all' in profile_stages:
+        profile = profiles.setdefault(stage, cProfile.Profile())
+        profile.enable()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+
+        if profile is not None:
+            profile.disable()
+
+        stats['timers'][stage] = stats['timers'].get(stage, 0) + elapsed
+        if day is not None:
+            day_timers = stats['days'].setdefault(str(day), {})
+            day_timers[stage] = day_timers.get(stage, 0) + elapsed
+
+
+@contextmanager
+def counter_group(key):
+    """
+    Also count every counter in the body of a with block under a group, e.g. the k of a sweep
+
+    e.g.
+        with counter_group(k):
+            means = cluster(data, k)
+    """
+
+    global group
+
+    previous = group
+    group = key
+    try:
+        yield
+    finally:
+        group = previous
+
+
+def count(name, value=1):
+    """Add value to a counter, and to the counter of the current group if there is one"""
+
+    stats['counters'][name] = stats['counters'].get(name, 0) + int(value)
+
+    if group is not None:
+        counters = stats['groups'].setdefault(group, {})
+        counters[name] = counters.get(name, 0) + int(value)
+
+
+def count_file(name, path):
+    """Add the size of the file at path to a byte counter"""
+
+    count(name, getsize(path))
+
+
+def take():
+    """
+    Hand back the stats of this process (e.g. from a pool worker) and start counting from zero
+
+    Any profiles are dumped to the profile directory, one file per process and stage
+    """
+
+    global stats
+
+    taken = stats
+    stats = {'timers': {}, 'counters': {}, 'days': {}, 'groups': {}}
+
+    for stage, profile in profiles.items():
+        profile.dump_stats(f"{profile_dir}/{stage}.{getpid()}.prof")
+
+    return taken
+
+
+def merge(other):
+    """Add the stats taken from another process to the stats of this process"""
+
+    for stage, elapsed in other['timers'].items():
+        stats['timers'][stage] = stats['timers'].get(stage, 0) + elapsed
+
+    for name, value in other['counters'].items():
+        count(name, value)
+
+    for key, counters in other['groups'].items():
+        merged = stats['groups'].setdefault(key, {})
+        for name, value in counters.items():
+            merged[name] = merged.get(name, 0) + value
+
+    for day, day_timers in other['days'].items():
+        merged = stats['days'].setdefault(day, {})
+        for stage, elapsed in day_timers.items():
+            merged[stage] = merged.get(stage, 0) + elapsed
+
+
+def enable_profiling(stages, output_dir):
+    """
+    Profile every timer of the given stages with cProfile ('all' profiles every stage)
+
+    Call before starting any pool, so the workers inherit it
+    """
+
+    global profile_stages, profile_dir
+
+    profile_stages = set(stages.split(',')) if isinstance(stages, str) else set(stages)
+    profile_dir = f"{output_dir}/{PROFILE_DIRECTORY}"
+
+    try:
+        makedirs(profile_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def write_profiles():
+    """Merge the profiles dumped by every process into one .prof and a text summary per stage"""
+
+    if profile_dir is None:
+        return
+
+    take()
+
+    parts = {}
+    for path in glob(f"{profile_dir}/*.*.prof"):
+        parts.setdefault(path.split('/')[-1].split('.')[0], []).append(path)
+
+    for stage, paths in parts.items():
+        merged = pstats.Stats(*paths)
+        merged.dump_stats(f"{profile_dir}/{stage}.prof")
+
+        with open(f"{profile_dir}/{stage}.txt", 'w') as outfile:
+            pstats.Stats(f"{profile_dir}/{stage}.prof", stream=outfile).sort_stats('cumulative').print_stats(PROFILE_LINES)
+
+        for path in paths:
+            remove(path)
+
+
+def write_report(output_dir, name, wall_time, group_dirs=None):
+    """
+    Write the stats of this process (merged with every worker's) as a run report, and any profiles
+
+    The stage times are summed over all processes, so they can add up to more than the wall time of the run.
+    For each day, io is the fraction of its time spent in the read and write stages.
+
+    parameters:
+     - output_dir : directory to write the report in
+     - name : name of the script, the report is written to <name>_report.json and <name>_report.csv
+     - wall_time : wall time of the whole run in seconds
+     - group_dirs : dict of counter group -> directory to also write a report of that group to (see counter_group),
+                    counters counted in any group are replaced by the group's, the rest and the timers are shared
+    """
+
+    write_report_files(output_dir, name, wall_time, stats['counters'])
+
+    grouped = {counter for counters in stats['groups'].values() for counter in counters}
+    for key, directory in (group_dirs or {}).items():
+        counters = stats['groups'].get(key, {})
+        write_report_files(directory, name, wall_time, {
+            counter: counters.get(counter, 0) if counter in grouped else value for counter, value in stats['counters'].items()
+        })
+
+    print(f"{name}: {wall_time:.2f}s", ', '.join(f"{stage} {elapsed:.2f}s" for stage, elapsed in stats['timers'].items()))
+
+    write_profiles()
+
+
+def write_report_files(output_dir, name, wall_time, counters):
+    """Write <name>_report.json and <name>_report.csv with the timers of this process and the given counters"""
+
+    timers = stats['timers']
+
+    report = {
+        'wall_time': wall_time,
+        'timers': timers,
+        'counters': counters,
+        'throughput': {},
+        'days': stats['days'],
+    }
+
+    if timers.get('read'):
+        report['throughput']['read_mb_per_s'] = counters.get(BYTES_READ, 0) / timers['read'] / 2**20
+    if timers.get('write'):
+        report['throughput']['write_mb_per_s'] = counters.get(BYTES_WRITTEN, 0) / timers['write'] / 2**20
+    if timers.get('compute'):
+        report['throughput']['cells_per_s'] = counters.get(CELLS, 0) / timers['compute']
+
+    with open(f"{output_dir}/{name}_{REPORT_SUFFIX}.json", 'w') as outfile:
+        json.dump(report, outfile, indent=1)
+
+    stages = list(timers)
+    with open(f"{output_dir}/{name}_{REPORT_SUFFIX}.csv", 'w') as outfile:
+        outfile.write(','.join(['day', *stages, 'io']) + '\n')
+
+        for day, day_timers in sorted(stats['days'].items(), key=lambda item: day_sort_key(item[0])):
+            total = sum(day_timers.values())
+            io = (day_timers.get('read', 0) + day_timers.get('write', 0)) / total if total else 0
+            outfile.write(','.join([day, *[f"{day_timers.get(stage, 0):.6f}" for stage in stages], f"{io:.3f}"]) + '\n')
+
+
+def day_sort_key(day):
+    return (0, int(day), '') if day.isdigit() else (1, 0, day)
@@ -0,0 +1,317 @@
+import numpy as np
+
+"""
+file: kmeans
+
+purpose:
+ - array-native 1-D k-means engines, used by fcluster alongside cluster_fast_dataset
+ - every engine takes a sorted dataset and k, and returns (means, iterations, operations)
+ - the prefix and optimal engines also take optional weights, to cluster a histogram of the data
+"""
+
+HISTOGRAM_BINS = 65536      # the ERA5 source values are packed into shorts, so at most 2^16 distinct values
+
+
+def linear_means(dataset, k):
+    """Simple linear interpolation between the minimum and maximum of a sorted dataset"""
+
+    minimum = dataset[0]
+    maximum = dataset[len(dataset)-1]
+    steps = np.arange(k) / k
+
+    return steps*maximum + (1-steps)*minimum
+
+
+def prefix_sums(dataset):
+    """
+    Cumulative sums of a sorted dataset with a leading zero,
+    so that sum(dataset[start:end]) == sums[end] - sums[start]
+    """
+
+    return np.concatenate(([0], np.cumsum(dataset, dtype=np.float64)))
+
+
+def histogram_counts(dataset, minimum, width, bins=HISTOGRAM_BINS):
+    """
+    Count and sum the datapoints in each of a fixed number of equal width bins starting at minimum,
+    so the counts and sums of several datasets (e.g. every day of a cube) can be added up
+
+    returns:
+     - number of datapoints in each bin
+     - sum of the datapoints in each bin
+    """
+
+    if width > 0:
+        index = np.clip(((dataset - minimum) / width).astype(np.intp), 0, bins - 1)
+    else:
+        index = np.zeros(len(dataset), dtype=np.intp)
+
+    return (np.bincount(index, minlength=bins), np.bincount(index, weights=dataset, minlength=bins))
+
+
+def histogram_values(counts, sums):
+    """
+    Turn the counts and sums of histogram_counts into the sorted values and weights of the non-empty bins
+    """
+
+    nonempty = counts > 0
+
+    return (sums[nonempty] / counts[nonempty], counts[nonempty])
+
+
+def histogram(dataset, bins=HISTOGRAM_BINS):
+    """
+    Quantize a dataset into a fixed number of equal width bins, without sorting it
+
+    Each non-empty bin is represented by the mean of the datapoints inside it,
+    and weighted by the number of datapoints inside it
+
+    returns:
+     - sorted bin values
+     - bin weights
+    """
+
+    minimum = np.min(dataset)
+    width = (np.max(dataset) - minimum) / bins
+
+    return histogram_values(*histogram_counts(dataset, minimum, width, bins))
+
+
+def cluster_prefix_sum(dataset, k, weights=None, means=None):
+    """
+    cluster_prefix_sum
+
+    Lloyd iterations over a sorted dataset. The cumulative sums are computed once, then each iteration
+    finds all k-1 dividers with a single searchsorted on the midpoints between means, and reads every
+    cluster sum and count from differences of the cumulative sums. The cost of an iteration does not
+    depend on how far the dividers move.
+
+    parameters:
+     - dataset : sorted dataset to cluster
+     - k : number of clusters
+     - weights : weight of each datapoint (1 if None)
+     - means : sorted initial means, e.g. the previous day's (linear interpolation between min and max if None)
+
+    returns:
+     - cluster means
+     - number of iterations
+     - number of operations (binary search steps to place the dividers)
+    """
+
+    n = len(dataset)
+    if weights is None:
+        counts = np.arange(n + 1)
+        sums = prefix_sums(dataset)
+    else:
+        counts = prefix_sums(weights)
+        sums = prefix_sums(dataset * weights)
+    search_steps = int(np.ceil(np.log2(n + 1)))
+
+    new_means = linear_means(dataset, k) if means is None else np.array(means, dtype=np.float64)
+    means = np.full(len(new_means), np.nan)
+
+    iters = 0
+    operations = 0
+    while not np.array_equal(means, new_means):
+        iters += 1
+        means = new_means
+
+        # The divider between two clusters is the first datapoint >= the midpoint between their means
+        midpoints = (means[:-1] + means[1:]) / 2
+        dividers = np.searchsorted(dataset, midpoints, side='left')
+        operations += len(midpoints) * search_steps
+
+        starts = np.concatenate(([0], dividers))
+        ends = np.concatenate((dividers, [n]))
+
+        # If there is an empty cluster (or multiple) just get rid of it.
+        nonempty = ends > starts
+        starts = starts[nonempty]
+        ends = ends[nonempty]
+
+        new_means = (sums[ends] - sums[starts]) / (counts[ends] - counts[starts])
+
+    return (new_means, iters, operations)
+
+
+def segment_cost(counts, sums, squares, starts, ends):
+    """Sum of squared distances to the mean of each segment dataset[starts:ends], from prefix sums"""
+
+    segment_sums = sums[ends] - sums[starts]
+
+    return (squares[ends] - squares[starts]) - segment_sums * segment_sums / (counts[ends] - counts[starts])
+
+
+def optimal_row(previous, counts, sums, squares, r, n):
+    """
+    Fill one row of the optimal 1-D k-means dynamic program with divide and conquer
+
+    cost[j] = min over m of previous[m] + segment_cost(m, j), for r clusters covering dataset[0:j].
+    The best m never decreases as j increases, so solving the middle j of a range splits the candidate
+    m's for both halves. All ranges on the same level of the recursion are solved together, giving
+    O(log n) vectorized passes of O(n) work each.
+
+    returns:
+     - cost of the best r clusters for every j (inf where j < r)
+     - best start of the last cluster for every j
+     - number of candidates evaluated
+    """
+
+    cost = np.full(n + 1, np.inf)
+    best = np.zeros(n + 1, dtype=np.intp)
+    operations = 0
+
+    # Ranges of j still to solve (lo..hi) and their candidate m's (opt_lo..opt_hi), inclusive
+    lo = np.array([r])
+    hi = np.array([n])
+    opt_lo = np.array([r - 1])
+    opt_hi = np.array([n - 1])
+
+    while len(lo) > 0:
+        mid = (lo + hi) // 2
+        lengths = np.minimum(opt_hi, mid - 1) - opt_lo + 1
+
+        # Flatten every candidate of every range into one array
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        segment = np.repeat(np.arange(len(mid)), lengths)
+        m = opt_lo[segment] + np.arange(len(segment)) - offsets[segment]
+        j = mid[segment]
+
+        candidates = previous[m] + segment_cost(counts, sums, squares, m, j)
+        operations += len(candidates)
+
+        # Take the first (lowest) m with the minimum cost in each range
+        minimums = np.minimum.reduceat(candidates, offsets)
+        at_minimum = np.flatnonzero(candidates == minimums[segment])
+        first = at_minimum[np.concatenate(([True], segment[at_minimum][1:] != segment[at_minimum][:-1]))]
+        best_m = m[first]
+
+        cost[mid] = minimums
+        best[mid] = best_m
+
+        # Split every range around its middle
+        left = lo <= mid - 1
+        right = mid + 1 <= hi
+        lo, hi, opt_lo, opt_hi = (
+            np.concatenate((lo[left], mid[right] + 1)),
+            np.concatenate((mid[left] - 1, hi[right])),
+            np.concatenate((opt_lo[left], best_m[right])),
+            np.concatenate((best_m[left], opt_hi[right])),
+        )
+
+    return cost, best, operations
+
+
+def cluster_optimal(dataset, k, weights=None, means=None):
+    """
+    cluster_optimal
+
+    Exact 1-D k-means: dynamic programming over the sorted dataset finds the globally optimal clusters,
+    with no dependence on initialisation and a predictable O(k n log n) runtime.
+
+    parameters:
+     - dataset : sorted dataset to cluster
+     - k : number of clusters (reduced to the number of distinct values if there are fewer)
+     - weights : weight of each datapoint (1 if None)
+     - means : unused, the optimal clusters don't depend on a starting point
+
+    returns:
+     - cluster means
+     - number of iterations (one per dynamic programming row)
+     - number of operations (candidate clusters evaluated)
+    """
+
+    return cluster_optimal_sweep(dataset, [k], weights)[0]
+
+
+def cluster_optimal_sweep(dataset, ks, weights=None):
+    """
+    cluster_optimal for several values of k at once
+
+    The dynamic program for the largest k also holds the optimal clusters for every smaller k,
+    so it is only filled once
+
+    returns:
+     - a list with the result of cluster_optimal for each k in ks
+    """
+
+    n = len(dataset)
+    distinct = 1 + np.count_nonzero(np.diff(dataset))
+    max_k = min(max(ks), distinct)
+
+    if weights is None:
+        weights = np.ones(n)
+
+    # Centre the data so the squared prefix sums don't lose precision
+    centred = dataset - np.average(dataset, weights=weights)
+    counts = prefix_sums(weights)
+    sums = prefix_sums(weights * centred)
+    squares = prefix_sums(weights * centred * centred)
+
+    ends = np.arange(n + 1)
+    cost = np.full(n + 1, np.inf)
+    cost[1:] = segment_cost(counts, sums, squares, 0, ends[1:])
+
+    operations = [0, n]
+    best = [None] * (max_k + 1)
+    for r in range(2, max_k + 1):
+        cost, best[r], row_operations = optimal_row(cost, counts, sums, squares, r, n)
+        operations.append(operations[-1] + row_operations)
+
+    raw_sums = prefix_sums(dataset * weights)
+
+    results = []
+    for k in ks:
+        k = min(k, distinct)
+
+        # Walk back through the best starts to recover the clusters
+        bounds = [n]
+        for r in range(k, 1, -1):
+            bounds.append(best[r][bounds[-1]])
+        bounds.append(0)
+        bounds = np.array(bounds[::-1])
+
+        means = (raw_sums[bounds[1:]] - raw_sums[bounds[:-1]]) / (counts[bounds[1:]] - counts[bounds[:-1]])
+        results.append((means, k, operations[k]))
+
+    return results
+
+
+def split_means(dataset, means, k, weights=None):
+    """
+    Seed k means from a solution with fewer clusters (e.g. the k-1 solution), by repeatedly splitting
+    the cluster with the largest sum of squared errors in two at its mean
+
+    returns:
+     - sorted means (fewer than k if there are no clusters left to split)
+    """
+
+    if weights is None:
+        weights = np.ones(len(dataset))
+
+    centred = dataset - np.average(dataset, weights=weights)
+    counts = prefix_sums(weights)
+    sums = prefix_sums(weights * centred)
+    squares = prefix_sums(weights * centred * centred)
+    raw_sums = prefix_sums(dataset * weights)
+
+    means = np.array(means, dtype=np.float64)
+    while len(means) < k:
+        dividers = np.searchsorted(dataset, (means[:-1] + means[1:]) / 2, side='left')
+        starts = np.concatenate(([0], dividers))
+        ends = np.concatenate((dividers, [len(dataset)]))
+
+        errors = np.zeros(len(means))
+        nonempty = ends > starts
+        errors[nonempty] = segment_cost(counts, sums, squares, starts[nonempty], ends[nonempty])
+
+        i = np.argmax(errors)
+        split = np.searchsorted(dataset, means[i], side='left')
+        if errors[i] <= 0 or not starts[i] < split < ends[i]:
+            break
+
+        lower = (raw_sums[split] - raw_sums[starts[i]]) / (counts[split] - counts[starts[i]])
+        upper = (raw_sums[ends[i]] - raw_sums[split]) / (counts[ends[i]] - counts[split])
+        means = np.concatenate((means[:i], [lower, upper], means[i+1:]))
+
+    return means
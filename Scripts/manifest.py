@@ -0,0 +1,103 @@
+from os import replace
+from os.path import isfile
+import hashlib
+import json
+import time
+import numpy as np
+
+"""
+file: manifest
+
+purpose:
+ - let every stage skip the days whose inputs and parameters haven't changed since it last ran
+ - each output directory keeps a manifest.json with the parameters of the run that produced it,
+   and for every finished day: a hash of its input, its outputs, and any small result (e.g. min/max) needed to rebuild summaries
+ - a day is stale if the parameters changed, its input hash changed, or it has no record (e.g. a new day, or the run crashed before it)
+ - the manifest is rewritten as days finish (at most every few seconds), so an interrupted run picks up close to where it stopped
+"""
+
+MANIFEST_FILENAME = 'manifest.json'
+
+HASH_SIZE = 16          # bytes
+WRITE_INTERVAL = 5      # seconds between rewrites of the manifest while days are still finishing
+
+
+def hash_arrays(*arrays):
+    """Hash the contents, shapes and types of arrays (e.g. the slices of a cube for one day)"""
+
+    digest = hashlib.blake2b(digest_size=HASH_SIZE)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        digest.update(array.data)
+
+    return digest.hexdigest()
+
+
+def read_manifest(directory, params):
+    """
+    Read the manifest in directory, starting a new one if there is none or it was made with different parameters
+
+    parameters:
+     - directory : output directory
+     - params : json-able dict of every parameter that changes the outputs
+    """
+
+    params = json.loads(json.dumps(params))
+
+    try:
+        with open(f"{directory}/{MANIFEST_FILENAME}", 'r') as my_file:
+            manifest = json.load(my_file)
+    except FileNotFoundError:
+        manifest = None
+
+    if manifest is None or manifest.get('params') != params:
+        manifest = {'params': params, 'days': {}}
+
+    # Bookkeeping that isn't written to the file starts with an underscore
+    manifest['_directory'] = directory
+    manifest['_written'] = time.monotonic()
+
+    return manifest
+
+
+def write_manifest(manifest, force=True):
+    """
+    Write the manifest back to its directory, replacing the old one in a single step
+
+    Unless forced, skip writing if it was written less than WRITE_INTERVAL seconds ago
+    """
+
+    if not force and time.monotonic() - manifest['_written'] < WRITE_INTERVAL:
+        return
+
+    path = f"{manifest['_directory']}/{MANIFEST_FILENAME}"
+    contents = {key: value for key, value in manifest.items() if not key.startswith('_')}
+
+    with open(f"{path}.tmp", 'w') as outfile:
+        json.dump(contents, outfile)
+    replace(f"{path}.tmp", path)
+
+    manifest['_written'] = time.monotonic()
+
+
+def is_fresh(manifest, day, input_hash):
+    """Whether the outputs recorded for day were made from an input with the same hash, and are all still there"""
+
+    record = manifest['days'].get(str(day))
+
+    return record is not None and record['input'] == input_hash and all(isfile(path) for path in record['outputs'])
+
+
+def record_day(manifest, day, input_hash, outputs=None, result=None):
+    """Record a finished day (outputs is a list of output paths, result is any json-able summary of the day)"""
+
+    manifest['days'][str(day)] = {'input': input_hash, 'outputs': outputs or [], 'result': result}
+
+
+def forget_day(manifest, day):
+    manifest['days'].pop(str(day), None)
+
+
+def day_result(manifest, day):
+    return manifest['days'][str(day)]['result']
@@ -0,0 +1,141 @@
+import struct
+import zlib
+import numpy as np
+from matplotlib import colors
+from instrument import count_file, BYTES_WRITTEN
+
+"""
+file: raster
+
+purpose:
+ - cheap renderers for clustered grids, which only have a handful (at most k) of distinct values
+ - a discrete colormap with one colour per cluster mean, taken from the continuous colormap at that mean,
+   so the grid can be drawn as a raster (imshow) rather than contours
+ - indexed (palette) png files written straight from numpy, one byte per cell and no matplotlib figure at all
+"""
+
+MAX_LEVELS = 255            # most distinct values drawn with their own colour, palette index 0 is kept for NaN
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_COMPRESSION = 6
+
+
+def discrete_levels(data, max_levels=MAX_LEVELS):
+    """
+    The sorted distinct values of a grid (e.g. the cluster means of a clustered day)
+
+    returns:
+     - the values, or None if there are more than max_levels of them (e.g. data that hasn't been clustered)
+    """
+
+    values = np.unique(data[~np.isnan(data)])
+
+    return values if 0 < len(values) <= max_levels else None
+
+
+def level_boundaries(levels):
+    """Boundaries halfway between sorted levels, and just outside the first and last"""
+
+    levels = np.asarray(levels, dtype=np.float64)
+    if len(levels) == 1:
+        return np.array([levels[0] - 0.5, levels[0] + 0.5])
+
+    middles = (levels[:-1] + levels[1:]) / 2
+
+    return np.concatenate([[2 * levels[0] - middles[0]], middles, [2 * levels[-1] - middles[-1]]])
+
+
+def discrete_colormap(levels, cmap, norm):
+    """
+    Colormap with one colour per level, the colour of the continuous cmap at that level
+
+    parameters:
+     - levels : sorted distinct values, see discrete_levels
+     - cmap : the continuous colormap
+     - norm : the continuous normalization (e.g. the range of every day's data)
+
+    returns:
+     - ListedColormap of the colours
+     - BoundaryNorm mapping each level to its colour
+    """
+
+    listed = colors.ListedColormap(cmap(norm(levels)))
+    boundaries = level_boundaries(levels)
+
+    return (listed, colors.BoundaryNorm(boundaries, len(levels)))
+
+
+def palette_indices(data, cmap, norm):
+    """
+    Map a grid to palette indices and the palette, with index 0 for NaN
+
+    A grid with few distinct values gets one palette entry per value, otherwise the values are quantized to MAX_LEVELS
+    colours of the cmap
+
+    returns:
+     - uint8 array of palette indices, the shape of data
+     - (entries, 3) uint8 array of RGB colours, entry 0 is NaN
+    """
+
+    levels = discrete_levels(data)
+    nan = np.isnan(data)
+
+    if levels is not None:
+        indices = np.searchsorted(level_boundaries(levels)[1:-1], np.where(nan, levels[0], data), side='right') + 1
+        rgb = cmap(norm(levels))[:, :3]
+    else:
+        scaled = np.clip(np.ma.getdata(norm(np.where(nan, norm.vmin, data))), 0, 1)
+        indices = np.rint(scaled * (MAX_LEVELS - 1)).astype(np.intp) + 1
+        rgb = cmap(np.linspace(0, 1, MAX_LEVELS))[:, :3]
+
+    indices = np.where(nan, 0, indices).astype(np.uint8)
+    palette = np.concatenate([np.ones((1, 3)), rgb])
+
+    return (indices, np.rint(palette * 255).astype(np.uint8))
+
+
+def scale_up(indices, scale):
+    """Enlarge a 2d array by an integer factor, each value becomes a scale x scale block"""
+
+    return np.repeat(np.repeat(indices, scale, axis=0), scale, axis=1) if scale > 1 else indices
+
+
+def palette_rgba(indices, palette, scale=1):
+    """The (height, width, 4) RGBA image of palette indices (e.g. a video frame), NaN is drawn in its opaque palette colour"""
+
+    rgb = palette[scale_up(indices, scale)]
+
+    return np.concatenate([rgb, np.full((*rgb.shape[:2], 1), 255, dtype=np.uint8)], axis=2)
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def write_indexed_png(path, indices, palette, scale=1):
+    """
+    Write an indexed colour png, palette entry 0 is transparent
+
+    parameters:
+     - path : path of the png
+     - indices : 2d uint8 array of palette indices, the first row is the top of the image
+     - palette : (entries, 3) uint8 array of RGB colours (at most 256)
+     - scale : integer factor to enlarge the image by, each index becomes a scale x scale block
+    """
+
+    indices = scale_up(indices, scale)
+    (height, width) = indices.shape
+
+    # Each row starts with its filter type, 0 (none)
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = indices
+
+    with open(path, 'wb') as outfile:
+        outfile.write(PNG_SIGNATURE)
+        # 8 bit depth, colour type 3 (indexed), default compression, filter and no interlacing
+        outfile.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)))
+        outfile.write(png_chunk(b'PLTE', np.ascontiguousarray(palette, dtype=np.uint8).tobytes()))
+        outfile.write(png_chunk(b'tRNS', b'\x00'))
+        outfile.write(png_chunk(b'IDAT', zlib.compress(rows.tobytes(), PNG_COMPRESSION)))
+        outfile.write(png_chunk(b'IEND', b''))
+
+    count_file(BYTES_WRITTEN, path)
@@ -0,0 +1,271 @@
+from os import replace
+from os.path import isfile, basename, dirname
+import json
+import numpy as np
+from consts import TOTAL_LAT, TOTAL_LON, VARIABLES
+from instrument import count, BYTES_READ, BYTES_WRITTEN
+
+"""
+file: storage
+
+purpose:
+ - read and write the intermediate data shared by every stage (convert, cluster, plots)
+ - a directory holds a single cube.npy of shape (day, variable, lat, lon), memory-mapped for O(1) access to any day
+ - a single day can also be stored on its own as a .npy of shape (variable, lat, lon)
+ - values are float32, with NaN for missing cells
+ - the variable and day order, and the lat/lon of every grid cell centre, are kept in a metadata.json file next to the data
+"""
+
+EXT = 'npy'
+CUBE_FILENAME = f"cube.{EXT}"
+METADATA_FILENAME = 'metadata.json'
+
+DTYPE = np.float32
+
+
+def write_metadata(directory, variables=VARIABLES, days=None, grid=None):
+    """Write the metadata describing the data in directory (grid is a dict of the cell centre 'lats' and 'lons')"""
+
+    metadata = {'variables': list(variables)}
+    if days is not None:
+        metadata['days'] = list(days)
+    if grid is not None:
+        metadata['lats'] = list(grid['lats'])
+        metadata['lons'] = list(grid['lons'])
+
+    with open(f"{directory}/{METADATA_FILENAME}", 'w') as outfile:
+        json.dump(metadata, outfile)
+
+
+def read_metadata(directory):
+    """Read the metadata for the data in directory, falling back to the default variables"""
+
+    try:
+        with open(f"{directory}/{METADATA_FILENAME}", 'r') as my_file:
+            return json.load(my_file)
+    except FileNotFoundError:
+        return {'variables': list(VARIABLES)}
+
+
+def read_grid(path):
+    """
+    Read the grid of the data stored at path (either a single day file or a cube directory)
+
+    returns:
+     - dict with the latitudes ('lats', north to south) and longitudes ('lons') of the grid cell centres
+    """
+
+    metadata = read_metadata((dirname(path) or '.') if isfile(path) else path)
+
+    if 'lats' in metadata:
+        return {'lats': metadata['lats'], 'lons': metadata['lons']}
+
+    # Data converted before the grid was recorded is the whole globe, in 1 degree blocks of the 0.25 degree source points
+    return {
+        'lats': [90 - 0.375 - i for i in range(TOTAL_LAT)],
+        'lons': [0.375 + i for i in range(TOTAL_LON)],
+    }
+
+
+def save_day(directory, day, data, variables=VARIABLES):
+    """
+    Save the grids for a single day to its own file
+
+    parameters:
+     - directory : output directory
+     - day : day the grids belong to, used as the file name
+     - data : dict of variable -> 2d grid (NaN for missing cells)
+    """
+
+    stacked = np.stack([np.asarray(data[var], dtype=DTYPE) for var in variables])
+    np.save(f"{directory}/{day}.{EXT}", stacked)
+
+
+def load_day(filename):
+    """
+    Load the grids for a single day from its own file
+
+    The grids are memory-mapped read-only, copy them before modifying
+
+    returns:
+     - dict of variable -> 2d grid
+    """
+
+    variables = read_metadata(dirname(filename) or '.')['variables']
+    stacked = np.load(filename, mmap_mode='r')
+
+    return {var: stacked[i] for i, var in enumerate(variables)}
+
+
+def has_cube(directory):
+    return isfile(f"{directory}/{CUBE_FILENAME}")
+
+
+def prepare_day_directory(directory, variables, grid=None):
+    """
+    Write the metadata for single day files of variables in directory, so they can be read back (see load_day)
+
+    A directory that already holds a cube keeps its metadata (and days) as they are, the day files are written next to it
+
+    raises:
+     - ValueError if the cube has different variables or grid, as the day files would be read back with them
+    """
+
+    if not has_cube(directory):
+        write_metadata(directory, variables, grid=grid)
+        return
+
+    metadata = read_metadata(directory)
+    if metadata['variables'] != list(variables):
+        raise ValueError(f"{directory} holds a cube of {', '.join(metadata['variables'])}, choose another output directory")
+
+    if grid is not None and read_grid(directory) != {'lats': list(grid['lats']), 'lons': list(grid['lons'])}:
+        raise ValueError(f"{directory} holds a cube on a different grid, choose another output directory")
+
+
+def create_cube(directory, days, grid_shape, variables=VARIABLES, grid=None):
+    """
+    Create an empty cube for days x variables in directory, and write its metadata (with the grid, if given)
+
+    returns:
+     - the cube, memory-mapped for writing
+    """
+
+    write_metadata(directory, variables, days, grid)
+
+    return np.lib.format.open_memmap(
+        f"{directory}/{CUBE_FILENAME}",
+        mode='w+',
+        dtype=DTYPE,
+        shape=(len(days), len(variables), *grid_shape),
+    )
+
+
+def open_cube(directory, mode='r'):
+    """
+    Memory-map the cube in directory
+
+    returns:
+     - the cube, shaped (day, variable, lat, lon)
+     - the cube metadata
+    """
+
+    cube = np.load(f"{directory}/{CUBE_FILENAME}", mmap_mode=mode)
+
+    return cube, read_metadata(directory)
+
+
+def cube_day(cube, metadata, index):
+    """Slice the index'th day out of an open cube as a dict of variable -> 2d grid"""
+
+    return {var: cube[index, i] for i, var in enumerate(metadata['variables'])}
+
+
+def day_count(path):
+    """Number of days stored at path (either a single day file or a cube directory)"""
+
+    if isfile(path):
+        return 1
+
+    return len(read_metadata(path)['days'])
+
+
+def read_day(path, index=0):
+    """
+    Read the grids for a single day, from either a single day file or the index'th day of a cube directory
+
+    returns:
+     - the day
+     - dict of variable -> 2d grid (memory-mapped read-only)
+    """
+
+    if isfile(path):
+        day, data = basename(path).split('.')[0], load_day(path)
+    else:
+        cube, metadata = open_cube(path)
+        day, data = metadata['days'][index], cube_day(cube, metadata, index)
+
+    count(BYTES_READ, sum(grid.nbytes for grid in data.values()))
+
+    return day, data
+
+
+def write_day(directory, index, day, data):
+    """
+    Write the grids for a single day, into row index of the cube in directory if there is one, otherwise to its own file
+
+    index must be the day's row in that cube (e.g. it was read from a cube with the same layout), a day read from
+    its own file has no row (None) and is always written to its own file
+    """
+
+    count(BYTES_WRITTEN, sum(np.size(grid) for grid in data.values()) * np.dtype(DTYPE).itemsize)
+
+    if index is None or not has_cube(directory):
+        save_day(directory, day, data, list(data))
+        return
+
+    cube, metadata = open_cube(directory, mode='r+')
+    for i, var in enumerate(metadata['variables']):
+        cube[index, i] = data[var]
+    cube.flush()
+
+
+def iter_days(path):
+    """Iterate over (day, data) for every day stored at path, in order"""
+
+    if isfile(path):
+        yield read_day(path)
+        return
+
+    cube, metadata = open_cube(path)
+    for index, day in enumerate(metadata['days']):
+        yield day, cube_day(cube, metadata, index)
+
+
+def update_cube(directory, days, grid_shape, variables=VARIABLES, grid=None):
+    """
+    Like create_cube, but keep the data of any days already in a cube in directory with the same variables and grid,
+    so only new or changed days need to be written
+
+    returns:
+     - the cube, memory-mapped for writing
+     - the days whose data was kept
+    """
+
+    days = list(days)
+    variables = list(variables)
+
+    if not has_cube(directory):
+        return create_cube(directory, days, grid_shape, variables, grid), set()
+
+    old_cube, metadata = open_cube(directory)
+
+    if (
+        metadata['variables'] != variables
+        or old_cube.shape[2:] != tuple(grid_shape)
+        or (grid is not None and read_grid(directory) != {'lats': list(grid['lats']), 'lons': list(grid['lons'])})
+    ):
+        return create_cube(directory, days, grid_shape, variables, grid), set()
+
+    old_days = metadata.get('days', [])
+    if old_days == days:
+        if grid is not None:
+            write_metadata(directory, variables, days, grid)
+        return open_cube(directory, mode='r+')[0], set(days)
+
+    # The days changed (e.g. new days were added), copy the days we already have into a new cube and swap it in
+    old_index = {day: i for i, day in enumerate(old_days)}
+    kept = [day for day in days if day in old_index]
+
+    path = f"{directory}/{CUBE_FILENAME}"
+    cube = np.lib.format.open_memmap(f"{path}.tmp", mode='w+', dtype=DTYPE, shape=(len(days), len(variables), *grid_shape))
+    for index, day in enumerate(days):
+        if day in old_index:
+            cube[index] = old_cube[old_index[day]]
+    cube.flush()
+
+    del old_cube, cube
+    replace(f"{path}.tmp", path)
+    write_metadata(directory, variables, days, grid)
+
+    return open_cube(directory, mode='r+')[0], set(kept)
@@ -1,6 +1,7 @@
+import time
 import numpy as np
 import multiprocessing as mp
-from fcluster import cluster_fast_dataset
+from fcluster import cluster_fast_dataset, ENGINES
 
 
 def main():
@@ -34,6 +35,9 @@ def main():
     # do_normal_tests(iterations_per_core, max_size, mid_k)
     # do_overlap_tests(iterations_per_core, max_size, mid_k)
 
+    # Compare every fcluster engine on the same datasets
+    # do_engine_tests(iterations_per_core, min_size, mid_k)
+
     do_scale_n_tests(iterations_per_core, min_size, max_size, step_size, mid_k)
 
 
@@ -115,6 +119,32 @@ def do_scale_n_tests(iterations_each, min_size, max_size, step_size, k):
     print(x_avgs)
 
 
+def do_engine_tests(iterations, size, k):
+    """
+    Compare the wall time and sum of squared errors of every fcluster engine on the same datasets
+
+    parameters:
+        - iterations : number of datasets to cluster
+        - size : size of the overlapped normal distribution
+    """
+
+    mids = [200, 800, 1200, 1500]
+    stddev = 150
+    datasets = [np.sort(get_overlap_distribution(size // len(mids), mids, stddev)) for _ in range(iterations)]
+
+    for name, engine in ENGINES.items():
+        elapsed = 0
+        error_sum = 0
+        for dataset in datasets:
+            start = time.perf_counter()
+            (means, _, _) = engine(dataset.copy(), k)
+            elapsed += time.perf_counter() - start
+
+            error_sum += np.sum(np.min((dataset[:, None] - means[None, :])**2, axis=1))
+
+        print(f"The {name} engine took {elapsed / iterations:.4f}s on average with a sum of squared errors of {error_sum / iterations:.2f} for k={k} and size {size}")
+
+
 def do_n_tests_parallel(iterations_per_core, method, k, *args):
     num_cores = mp.cpu_count()
 
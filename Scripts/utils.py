@@ -1,21 +1,13 @@
 from datetime import datetime
-from consts import DEG, YEAR
+from consts import REGISTRY, YEAR
 
 
 def get_units(var):
-    if var == 'mean_sea_level_pressure':
-        return 'kPa'
-    else:
-        return DEG + ' C'
+    return REGISTRY[var]['units']
 
 
 def get_english_variable_name(var):
-    if var == 'two_metre_temperature':
-        return 'Two Metre Temperature'
-    if var == 'mean_sea_level_pressure':
-        return 'Mean Sea Level Pressure'
-    if var == 'sea_surface_temperature':
-        return 'Sea Surface Temperature'
+    return REGISTRY[var]['name']
 
 
 def day_str(day):
@@ -27,3 +19,75 @@ def day_str(day):
 
     dt = datetime.strptime(padded, "%j")
     return dt.strftime(f"%B %d, {YEAR}")
+
+
+def day_month(day):
+    """
+    Convert an integer day to its month
+    e.g. 31 -> 2
+    """
+    padded = f"{int(day)+1:03d}"
+
+    return datetime.strptime(padded, "%j").month
+
+
+def parse_range_list(value):
+    """
+    Parse a comma separated list of integers and inclusive ranges, with an optional step
+    e.g. "5-7,10" -> [5, 6, 7, 10], "10-50:20" -> [10, 30, 50]
+    """
+    values = []
+    for part in str(value).split(','):
+        if '-' in part:
+            part, step = part.split(':') if ':' in part else (part, 1)
+            start, end = part.split('-')
+            values.extend(range(int(start), int(end) + 1, int(step)))
+        else:
+            values.append(int(part))
+
+    return values
+
+
+def is_first_of_month(day):
+    """Whether an integer day is the first day of its month"""
+
+    return int(day) == 0 or day_month(day) != day_month(int(day) - 1)
+
+
+def select_days(days, selection=None):
+    """
+    Select days by a comma separated list of day numbers and inclusive ranges (see parse_range_list),
+    and calendar selectors
+     - first-of-month : the first day of every month
+     - every:<n> : every nth day, starting from the first day
+    A day is selected if any part of the list selects it
+    e.g. "first-of-month", "every:7", "0-30,first-of-month"
+
+    parameters:
+     - days : the (ordered) integer days to select from
+     - selection : the selection, every day if None
+
+    returns:
+     - the indices into days of the selected days, in order
+    """
+    if not selection:
+        return list(range(len(days)))
+
+    numbers = set()
+    selectors = []
+    for part in str(selection).split(','):
+        part = part.strip()
+        if part == 'first-of-month':
+            selectors.append(lambda index, day: is_first_of_month(day))
+        elif part.startswith('every:'):
+            step = int(part[len('every:'):])
+            if step < 1:
+                raise ValueError(f"every:<n> needs a positive n, not {step}")
+            selectors.append(lambda index, day, step=step: index % step == 0)
+        else:
+            numbers.update(parse_range_list(part))
+
+    return [
+        index for index, day in enumerate(days)
+        if day in numbers or any(selector(index, day) for selector in selectors)
+    ]
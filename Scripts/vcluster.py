@@ -0,0 +1,240 @@
+from os import makedirs
+from os.path import isfile, isdir, dirname
+import argparse
+import errno
+import json
+import time
+import numpy as np
+import multiprocessing as mp
+from consts import CONVERTED_DIRECTORY, VCLUSTERED_DIRECTORY, DEFAULT_K
+from vkmeans import cluster_vectors, ENGINES, DEFAULT_ENGINE, STANDARDIZATIONS, DEFAULT_STANDARDIZATION, BLOCK_SIZE
+from fcluster import get_variable_ranges
+from storage import read_day, write_day, open_cube, update_cube, read_metadata, read_grid, prepare_day_directory
+from manifest import hash_arrays, read_manifest, write_manifest, is_fresh, record_day, day_result
+import instrument
+from instrument import timer, count, CELLS, ITERATIONS, DISTANCES
+
+"""
+file: vcluster
+
+purpose:
+ - cluster every cell of a day by all of its variables at once (e.g. temperature, pressure and sea surface temperature),
+   so each cluster is a weather regime rather than a band of a single variable
+ - each cell is a d-dimensional feature vector built from the per-variable grids, cells missing any variable are left out
+ - each variable is written out as the value of its cluster's mean, in the same cube / range.json layout as fcluster,
+   so the figure scripts work on the output as they are
+"""
+
+DEBUG = False
+
+
+def features(data, variables):
+    """
+    Stack the grids of the variables into one feature vector per cell
+
+    returns:
+     - (cells, variables) array of the cells that have every variable
+     - grid of which cells are included
+    """
+
+    stacked = np.stack([np.asarray(data[var], dtype=np.float64) for var in variables], axis=-1)
+    valid = ~np.isnan(stacked).any(axis=-1)
+
+    return (stacked[valid], valid)
+
+
+def vcluster(data, variables, k, seed=None, standardization=DEFAULT_STANDARDIZATION, engine=DEFAULT_ENGINE, block_size=BLOCK_SIZE):
+    """
+    vcluster
+
+    parameters:
+     - data : dict of variable -> 2d grid, NaN for missing cells
+     - variables : the variables to cluster on
+     - k : number of clusters
+     - seed : seed for the k-means++ initialisation (random if None)
+     - standardization : how to scale each variable before clustering (see vkmeans.standardize)
+     - engine : name of the d-dimensional k-means engine in vkmeans.ENGINES
+     - block_size : number of cells per block of distance computations
+
+    returns:
+     - dict of variable -> grid with each cell replaced by that variable of its cluster's mean
+     - dict of variable -> min/max of the data
+     - number of iterations
+    """
+
+    (points, valid) = features(data, variables)
+
+    clustered = {var: np.full(valid.shape, np.nan) for var in variables}
+    if len(points) == 0:
+        return (clustered, {var: (np.nan, np.nan) for var in variables}, 0)
+
+    (means, labels, iters, distances) = cluster_vectors(points, k, seed, standardization, engine, block_size)
+
+    count(CELLS, len(points))
+    count(ITERATIONS, iters)
+    count(DISTANCES, distances)
+
+    if DEBUG:
+        print(means)
+        print(iters, distances)
+
+    ranges = {}
+    for i, var in enumerate(variables):
+        clustered[var][valid] = means[labels, i]
+        ranges[var] = (float(np.min(points[:, i])), float(np.max(points[:, i])))
+
+    return (clustered, ranges, iters)
+
+
+def cluster_file(path, index, k, output_dir, variables, seed=None, standardization=DEFAULT_STANDARDIZATION,
+                 engine=DEFAULT_ENGINE, block_size=BLOCK_SIZE):
+    """
+    Given a day file (or a cube directory and day index) and k value, run vcluster on the day and write to output_dir
+
+    index is None for a day file, which is always written to its own file (see storage.write_day)
+
+    returns:
+     - the day index
+     - (the min/max values for each variable, the number of iterations)
+     - the instrument stats
+    """
+    if DEBUG:
+        print('Clustering', path, index)
+
+    with timer('read', index):
+        day, data = read_day(path, index)
+
+    with timer('compute', index):
+        (clustered, ranges, iters) = vcluster(data, variables, k, seed, standardization, engine, block_size)
+
+    with timer('write', index):
+        write_day(output_dir, index, day, clustered)
+
+    return (index, (ranges, iters), instrument.take())
+
+
+def cluster_file_task(task):
+    return cluster_file(*task)
+
+
+def write_iterations(output_dir, days, results):
+    """Write the number of iterations each day took to converge"""
+
+    iterations = {str(day): int(result[1]) for day, result in zip(days, results)}
+
+    with open(f"{output_dir}/iterations.json", 'w') as outfile:
+        json.dump(iterations, outfile)
+
+
+def init(output_dir):
+    """Initialization for the algorithm"""
+
+    # Create the output directory if it doesn't exist
+    try:
+        makedirs(output_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', help='Input day file or cube directory')
+    parser.add_argument('-o', '--output', help='Output subdirectory')
+    parser.add_argument('-k', '--k', type=int, help='k value', default=DEFAULT_K)
+    parser.add_argument('-v', '--variables', help='Comma separated variables to cluster on (all variables of the input if not set)')
+    parser.add_argument('-s', '--seed', type=int, help='Seed for the k-means++ initialisation', default=None)
+    parser.add_argument('-z', '--standardize', choices=STANDARDIZATIONS, help='How to scale each variable', default=DEFAULT_STANDARDIZATION)
+    parser.add_argument('-e', '--engine', choices=ENGINES.keys(), help='d-dimensional k-means engine', default=DEFAULT_ENGINE)
+    parser.add_argument('--block-size', type=int, help='Cells per block of distance computations', default=BLOCK_SIZE)
+    parser.add_argument('-f', '--force', action='store_true', help="Cluster every day, even if it hasn't changed since the last run")
+    parser.add_argument('-P', '--profile', help="Comma separated stages to profile with cProfile (read, compute, write), or 'all'")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+
+    # If we specify a custom output dir, place it inside the default output directory
+    output_dir = f"{VCLUSTERED_DIRECTORY}/{args.output}" if args.output else VCLUSTERED_DIRECTORY
+
+    init(output_dir)
+
+    if args.profile:
+        instrument.enable_profiling(args.profile, output_dir)
+
+    # If input is a single file, easy case
+    if args.input and isfile(args.input):
+        print('Cluster', args.input, output_dir)
+        variables = args.variables.split(',') if args.variables else read_metadata(dirname(args.input) or '.')['variables']
+
+        # The day is written to its own <day>.npy file, next to (never into) any cube already in the output directory
+        try:
+            prepare_day_directory(output_dir, variables, read_grid(args.input))
+        except ValueError as e:
+            parser.error(str(e))
+
+        instrument.merge(cluster_file(
+            args.input, None, args.k, output_dir, variables, args.seed, args.standardize, args.engine, args.block_size
+        )[2])
+        instrument.write_report(output_dir, 'vcluster', time.perf_counter() - start)
+        exit()
+
+    # Since input isn't a single file, it's either
+    #   a) a directory, or
+    #   b) not specified
+    input_dir = args.input if args.input and isdir(args.input) else CONVERTED_DIRECTORY
+
+    print('Cluster days in', input_dir)
+
+    input_cube, metadata = open_cube(input_dir)
+    days = metadata['days']
+    variables = args.variables.split(',') if args.variables else metadata['variables']
+
+    for var in variables:
+        if var not in metadata['variables']:
+            parser.error(f"{var} is not in {input_dir}, choose from {', '.join(metadata['variables'])}")
+
+    # The clustered days are written into a cube of the chosen variables, keeping the days clustered before
+    _, kept = update_cube(output_dir, days, input_cube.shape[2:], variables, read_grid(input_dir))
+    manifest = read_manifest(output_dir, {
+        'variables': variables,
+        'k': args.k,
+        'seed': args.seed,
+        'standardize': args.standardize,
+        'engine': args.engine,
+    })
+
+    # Only cluster the days whose input changed since the last run (or that were never clustered)
+    columns = [metadata['variables'].index(var) for var in variables]
+    input_hashes = [hash_arrays(input_cube[index, columns]) for index in range(len(days))]
+    stale = [
+        index for index, day in enumerate(days)
+        if args.force or not (day in kept and is_fresh(manifest, day, input_hashes[index]))
+    ]
+
+    print(f"Clustering {len(stale)} of {len(days)} days")
+
+    with mp.Pool(mp.cpu_count()) as pool:
+        tasks = [
+            (input_dir, index, args.k, output_dir, variables, args.seed, args.standardize, args.engine, args.block_size)
+            for index in stale
+        ]
+        for (index, result, day_stats) in pool.imap_unordered(cluster_file_task, tasks):
+            instrument.merge(day_stats)
+
+            record_day(manifest, days[index], input_hashes[index], result=result)
+            write_manifest(manifest, force=False)
+
+    write_manifest(manifest)
+
+    # Summaries are rebuilt from the manifest, which holds every day whether it was clustered in this run or before
+    results = [day_result(manifest, day) for day in days]
+
+    write_iterations(output_dir, days, results)
+
+    # Calculate min/max across the clusters for each variable
+    ranges = get_variable_ranges([result[0] for result in results])
+
+    with open(f"{output_dir}/range.json", 'w') as outfile:
+        json.dump(ranges, outfile)
+
+    instrument.write_report(output_dir, 'vcluster', time.perf_counter() - start)
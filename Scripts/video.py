@@ -0,0 +1,99 @@
+from itertools import chain
+from shutil import which
+import subprocess
+import numpy as np
+from PIL import Image
+from instrument import count_file, BYTES_WRITTEN
+
+"""
+file: video
+
+purpose:
+ - stream the frames of a figure straight into a video file, rather than saving every day as a png and
+   reading them back with ffmpeg (see convert_image_sequences)
+ - frames are the raw RGBA buffer of the matplotlib canvas, piped into an ffmpeg subprocess as they are drawn
+ - without ffmpeg, the frames are written to an animated gif with PIL instead
+"""
+
+FFMPEG = 'ffmpeg'
+DEFAULT_FPS = 30
+DEFAULT_DPI = 100           # the figures are 6.4 x 4.8 inches, so 640 x 480 frames
+
+
+def video_extension():
+    """Extension of the videos written by write_video, mp4 if ffmpeg is installed and gif otherwise"""
+
+    return 'mp4' if which(FFMPEG) else 'gif'
+
+
+def capture(figure):
+    """
+    Draw a figure and return its canvas as a (height, width, 4) RGBA array
+
+    The array is a view of the canvas, so it is only valid until the figure is drawn again
+    """
+
+    figure.canvas.draw()
+
+    return np.asarray(figure.canvas.buffer_rgba())
+
+
+def write_ffmpeg(path, frames, size, fps):
+    """Pipe raw RGBA frames of size (width, height) into ffmpeg, encoding them as h264"""
+
+    process = subprocess.Popen([
+        FFMPEG, '-y', '-hide_banner', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f"{size[0]}x{size[1]}", '-r', str(fps), '-i', '-',
+        # yuv420p needs an even width and height
+        '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p',
+        path,
+    ], stdin=subprocess.PIPE)
+
+    try:
+        for frame in frames:
+            process.stdin.write(np.ascontiguousarray(frame).data)
+    finally:
+        process.stdin.close()
+        process.wait()
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, FFMPEG)
+
+
+def write_gif(path, frames, size, fps):
+    """Write RGBA frames to an animated gif, each frame is converted as PIL asks for it"""
+
+    images = (Image.fromarray(frame[..., :3]) for frame in frames)
+
+    first = next(images)
+    first.save(path, save_all=True, append_images=images, duration=1000 / fps, loop=0)
+
+
+def write_video(path, frames, fps=DEFAULT_FPS):
+    """
+    Write a sequence of frames to a video
+
+    parameters:
+     - path : path of the video without its extension, see video_extension
+     - frames : iterable of (height, width, 4) RGBA arrays (e.g. from capture), all of the same size
+     - fps : frames per second
+
+    returns:
+     - the path written, or None if there were no frames
+    """
+
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return None
+
+    extension = video_extension()
+    path = f"{path}.{extension}"
+    size = (first.shape[1], first.shape[0])
+
+    writer = write_ffmpeg if extension == 'mp4' else write_gif
+    writer(path, chain([first], frames), size, fps)
+
+    count_file(BYTES_WRITTEN, path)
+
+    return path
@@ -0,0 +1,261 @@
+import numpy as np
+
+"""
+file: vkmeans
+
+purpose:
+ - k-means engines for d-dimensional feature vectors (e.g. the temperature, pressure and sea surface temperature of a cell),
+   used by vcluster
+ - the features can be standardised first, so no variable dominates the distances just because of its units
+ - the initial means are chosen with k-means++
+ - every engine takes an (n, d) array of points and the initial means, and returns (means, labels, iterations, distances)
+ - distances are computed one block of points at a time, so at most a (block, k) array of distances is held in memory
+ - hamerly keeps an upper bound on the distance from each point to its own mean and a lower bound on the distance to
+   every other mean, and uses the triangle inequality to skip the points whose cluster can't have changed
+"""
+
+BLOCK_SIZE = 16384          # points per block of distance computations
+MAX_ITERATIONS = 300
+
+STANDARDIZATIONS = ['zscore', 'range', 'none']
+DEFAULT_STANDARDIZATION = 'zscore'
+
+
+def standardize(points, method=DEFAULT_STANDARDIZATION):
+    """
+    Scale each feature (column) of points
+
+     - zscore : to a mean of 0 and a standard deviation of 1
+     - range : to between 0 and 1
+     - none : leave the points as they are
+
+    returns:
+     - the scaled points
+     - the centre and scale of each feature, so that points == scaled * scale + centre
+    """
+
+    if method == 'zscore':
+        centre = points.mean(axis=0)
+        scale = points.std(axis=0)
+    elif method == 'range':
+        centre = points.min(axis=0)
+        scale = points.max(axis=0) - centre
+    elif method == 'none':
+        centre = np.zeros(points.shape[1])
+        scale = np.ones(points.shape[1])
+    else:
+        raise ValueError(f"Unknown standardization {method}, choose from {', '.join(STANDARDIZATIONS)}")
+
+    # Leave constant features where they are rather than dividing by 0
+    scale = np.where(scale > 0, scale, 1)
+
+    return ((points - centre) / scale, centre, scale)
+
+
+def closest_means(points, means, block_size=BLOCK_SIZE):
+    """
+    Find the closest and second closest mean to every point, one block of points at a time
+
+    returns:
+     - index of the closest mean to each point
+     - distance to the closest mean
+     - distance to the second closest mean (inf if there is only one mean)
+    """
+
+    n = len(points)
+    k = len(means)
+
+    labels = np.empty(n, dtype=np.intp)
+    closest = np.empty(n)
+    second = np.full(n, np.inf)
+
+    mean_norms = np.einsum('ij,ij->i', means, means)
+
+    for start in range(0, n, block_size):
+        block = points[start:start+block_size]
+        rows = np.arange(len(block))
+
+        # |x - m|^2 = |x|^2 - 2 x.m + |m|^2, so the (block, k, d) differences are never made
+        distances = np.einsum('ij,ij->i', block, block)[:, np.newaxis] - 2 * block @ means.T + mean_norms
+        np.maximum(distances, 0, out=distances)
+
+        block_labels = np.argmin(distances, axis=1)
+        labels[start:start+block_size] = block_labels
+        closest[start:start+block_size] = distances[rows, block_labels]
+
+        if k > 1:
+            distances[rows, block_labels] = np.inf
+            second[start:start+block_size] = np.min(distances, axis=1)
+
+    return (labels, np.sqrt(closest), np.sqrt(second))
+
+
+def kmeans_plus_plus(points, k, rng):
+    """
+    Choose k initial means from the points, the first at random and each of the others with a probability
+    proportional to its squared distance from the closest mean chosen so far
+    """
+
+    n = len(points)
+    means = np.empty((k, points.shape[1]))
+
+    means[0] = points[rng.integers(n)]
+    closest = np.sum((points - means[0])**2, axis=1)
+
+    for i in range(1, k):
+        cumulative = np.cumsum(closest)
+
+        if cumulative[-1] > 0:
+            index = min(np.searchsorted(cumulative, rng.random() * cumulative[-1], side='right'), n - 1)
+        else:
+            # Every point is already a mean (fewer distinct points than k)
+            index = rng.integers(n)
+
+        means[i] = points[index]
+        closest = np.minimum(closest, np.sum((points - means[i])**2, axis=1))
+
+    return means
+
+
+def update_means(points, labels, means):
+    """Calculate the mean of the points in each cluster, an empty cluster keeps its previous mean"""
+
+    k = len(means)
+
+    counts = np.bincount(labels, minlength=k)
+    sums = np.stack([np.bincount(labels, weights=points[:, i], minlength=k) for i in range(points.shape[1])], axis=1)
+
+    new_means = means.copy()
+    nonempty = counts > 0
+    new_means[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+
+    return new_means
+
+
+def lloyd(points, means, block_size=BLOCK_SIZE, max_iterations=MAX_ITERATIONS):
+    """
+    Lloyd iterations, measuring the distance from every point to every mean on every iteration
+
+    returns:
+     - cluster means
+     - cluster label of each point
+     - number of iterations
+     - number of distances computed
+    """
+
+    n, k = len(points), len(means)
+
+    labels = None
+    iters = 0
+    distances = 0
+    while iters < max_iterations:
+        iters += 1
+
+        (new_labels, _, _) = closest_means(points, means, block_size)
+        distances += n * k
+
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+
+        labels = new_labels
+        means = update_means(points, labels, means)
+
+    return (means, labels, iters, distances)
+
+
+def hamerly(points, means, block_size=BLOCK_SIZE, max_iterations=MAX_ITERATIONS):
+    """
+    Hamerly's k-means: the same clusters as Lloyd iterations, skipping the distances that can't change a point's cluster
+
+    Every point keeps
+     - upper : an upper bound on the distance to its own mean
+     - lower : a lower bound on the distance to any other mean
+    When the means move, the bounds are loosened by how far they moved. A point can only change cluster if its upper bound
+    is more than both its lower bound and half the distance from its mean to the closest other mean, so only those points
+    are measured again.
+
+    returns:
+     - cluster means
+     - cluster label of each point
+     - number of iterations
+     - number of distances computed
+    """
+
+    n, k = len(points), len(means)
+
+    (labels, upper, lower) = closest_means(points, means, block_size)
+    iters = 1
+    distances = n * k
+
+    while iters < max_iterations:
+        new_means = update_means(points, labels, means)
+        moved = np.sqrt(np.sum((new_means - means)**2, axis=1))
+        means = new_means
+
+        if not moved.any():
+            break
+
+        iters += 1
+
+        upper += moved[labels]
+        if k > 1:
+            # The lower bound is to any other mean, so loosen it by the furthest any other mean moved
+            order = np.argsort(moved)
+            lower -= np.where(labels == order[-1], moved[order[-2]], moved[order[-1]])
+
+        # Half the distance from each mean to the closest other mean
+        between = np.sqrt(np.sum((means[:, np.newaxis] - means)**2, axis=2))
+        np.fill_diagonal(between, np.inf)
+        bound = np.maximum(np.min(between, axis=1)[labels] / 2, lower)
+
+        candidates = np.flatnonzero(upper > bound)
+        if len(candidates) == 0:
+            continue
+
+        # Tighten the upper bounds to the exact distance first, that's often enough to rule a point out
+        upper[candidates] = np.sqrt(np.sum((points[candidates] - means[labels[candidates]])**2, axis=1))
+        distances += len(candidates)
+
+        candidates = candidates[upper[candidates] > bound[candidates]]
+        if len(candidates) == 0:
+            continue
+
+        (labels[candidates], upper[candidates], lower[candidates]) = closest_means(points[candidates], means, block_size)
+        distances += len(candidates) * k
+
+    return (means, labels, iters, distances)
+
+
+# d-dimensional k-means engines, selectable with vcluster --engine
+ENGINES = {
+    'hamerly': hamerly,
+    'lloyd': lloyd,
+}
+DEFAULT_ENGINE = 'hamerly'
+
+
+def cluster_vectors(points, k, seed=None, standardization=DEFAULT_STANDARDIZATION, engine=DEFAULT_ENGINE, block_size=BLOCK_SIZE):
+    """
+    Cluster d-dimensional points into k clusters
+
+    parameters:
+     - points : (n, d) array of points (no NaN)
+     - k : number of clusters (fewer if there are fewer points)
+     - seed : seed for the k-means++ initialisation (random if None)
+     - standardization : how to scale each feature before clustering, one of STANDARDIZATIONS
+     - engine : name of the engine in ENGINES
+     - block_size : number of points per block of distance computations
+
+    returns:
+     - (k, d) cluster means, in the units of the points
+     - cluster label of each point
+     - number of iterations
+     - number of distances computed
+    """
+
+    (scaled, centre, scale) = standardize(points, standardization)
+
+    means = kmeans_plus_plus(scaled, min(k, len(points)), np.random.default_rng(seed))
+    (means, labels, iters, distances) = ENGINES[engine](scaled, means, block_size)
+
+    return (means * scale + centre, labels, iters, distances)
@@ -0,0 +1,118 @@
+import multiprocessing as mp
+import numpy as np
+from storage import open_cube
+import instrument
+from instrument import timer, count, counter_group, BYTES_READ, BYTES_WRITTEN
+
+"""
+file: workers
+
+purpose:
+ - a single worker pool for running a function over every day x variable of a cube
+ - each worker memory-maps the input and output cubes once when it starts, and is only handed
+   (day, variable) offsets, so grids are never pickled and the cubes are shared through the page cache
+ - tasks are scheduled in chunks over days x variables rather than whole days, to balance the load
+ - every task times its read, compute and write stages, and the stats are merged into the parent's (see instrument)
+"""
+
+TASKS_PER_WORKER = 4        # aim for this many chunks per worker so slow tasks can be balanced out
+
+input_cube = None
+output_cubes = None
+output_rows = None
+
+
+def init_worker(input_dir, output_dirs, rows=None):
+    """Memory-map the cubes once per worker"""
+
+    global input_cube, output_cubes, output_rows
+
+    input_cube, _ = open_cube(input_dir)
+    output_cubes = {key: open_cube(output_dir, mode='r+')[0] for key, output_dir in output_dirs.items()}
+    output_rows = rows
+
+
+def run_task(task):
+    """
+    Run the function over a sequence of days for a single variable
+
+    The function is called as function(grid, state, *args) for each day in order, and returns
+     - dict of output key -> grid, written to the matching output cube at the same (day, variable)
+     - a small result, handed back to the caller
+     - the state for the next day in the sequence (state starts as None)
+
+    Outputs are written to the day's row of the output cubes, which is its index unless the cubes only hold some days
+    """
+
+    (function, indices, variable, args) = task
+
+    state = None
+    results = []
+    for index in indices:
+        with timer('read', index):
+            grid = np.array(input_cube[index, variable], dtype=np.float64)
+            count(BYTES_READ, input_cube[index, variable].nbytes)
+
+        with timer('compute', index):
+            (outputs, result, state) = function(grid, state, *args)
+
+        with timer('write', index):
+            row = index if output_rows is None else output_rows[index]
+            for key, output in outputs.items():
+                output_cubes[key][row, variable] = output
+                with counter_group(key):
+                    count(BYTES_WRITTEN, output_cubes[key][row, variable].nbytes)
+
+        results.append((index, result))
+
+    with timer('write'):
+        for cube in output_cubes.values():
+            cube.flush()
+
+    return (variable, results, instrument.take())
+
+
+def run(function, input_dir, output_dirs, args=(), chains=None, processes=None, on_day=None, rows=None):
+    """
+    Run function over every day x variable of the cube in input_dir (see run_task)
+
+    parameters:
+     - function : function to run, must be importable by the workers
+     - input_dir : directory of the input cube
+     - output_dirs : dict of output key -> directory of an output cube with the same layout
+     - args : extra arguments for the function
+     - chains : lists of day indices to run in order, carrying the state between days (every day on its own if None)
+     - processes : number of workers (one per cpu if None)
+     - on_day : called as on_day(index, results[index]) as soon as every variable of a day has finished
+     - rows : dict of day index -> row of the output cubes, if they only hold some of the days (the same index if None)
+
+    returns:
+     - results[day index][variable index] = the result of the function (None for days not in any chain)
+    """
+
+    _, metadata = open_cube(input_dir)
+    days = len(metadata['days'])
+    variables = len(metadata['variables'])
+
+    if chains is None:
+        chains = [[index] for index in range(days)]
+    tasks = [(function, chain, variable, args) for chain in chains for variable in range(variables)]
+
+    processes = processes or mp.cpu_count()
+    chunksize = max(1, len(tasks) // (processes * TASKS_PER_WORKER))
+
+    results = [[None] * variables for _ in range(days)]
+    remaining = [variables] * days
+
+    with mp.Pool(processes, initializer=init_worker, initargs=(input_dir, output_dirs, rows)) as pool:
+        for (variable, task_results, task_stats) in pool.imap_unordered(run_task, tasks, chunksize):
+            instrument.merge(task_stats)
+
+            for (index, result) in task_results:
+                results[index][variable] = result
+
+                remaining[index] -= 1
+                if remaining[index] == 0 and on_day:
+                    on_day(index, results[index])
+
+    return results